@@ -1,7 +1,7 @@
-import cirq
 import json
 import numpy as np
-import qcircuits.circuits as qcircuits
+# cirq and the circuit library are imported when a circuit is built, so that
+# the circuit dimensions can be checked without loading the quantum stack
 class QCircuit:
 	def __init__(self, IEC_id, PQC_id, MC_id, n_layers=1, input_size=4, p=None):
 		self.n_layers = n_layers
@@ -21,6 +21,7 @@ class QCircuit:
 		self.n_measurements = self.get_measurements()
 
 	def model_circuit(self):
+		import cirq
 		self.qubits  = cirq.GridQubit.rect(self.n_qubits, 1)
 		self.circuit = cirq.Circuit()
 
@@ -31,12 +32,15 @@ class QCircuit:
 
 	def IEC(self):
 		'''information encoding circuit'''
+		import qcircuits.circuits as qcircuits
 		return getattr(qcircuits, self.metadata['qc_iec_dict'][self.IEC_id])
 	def PQC(self):
 		'''parametrized quantum circuit'''
+		import qcircuits.circuits as qcircuits
 		return getattr(qcircuits, self.metadata['qc_pqc_dict'][self.PQC_id])
 	def measurement_operators(self):
 		'''measurement block of the circuit'''
+		import qcircuits.circuits as qcircuits
 		
 		self.qc_meas_dict = {
 			'measure_all': qcircuits.measure_all,
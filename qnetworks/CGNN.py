@@ -1,5 +1,6 @@
 import tensorflow as tf
 import numpy as np
+from qnetworks.message_passing import stack_graph, edge_features, aggregate, prune_graph
 ################################################################################################### Define Edge Network
 class EdgeNet(tf.keras.layers.Layer):
     def __init__(self, name='EdgeNet', hid_dim=10):
@@ -11,10 +12,7 @@ class EdgeNet(tf.keras.layers.Layer):
             tf.keras.layers.Dense(1, activation='sigmoid'),
         ])
         
-    def call(self,X, Ri, Ro):
-        bo = tf.matmul(Ro,X,transpose_a=True)
-        bi = tf.matmul(Ri,X,transpose_a=True)
-
+    def call(self, bo, bi):
         # Shape of B = N_edges x 6 (2x (3 coordinates))
         # each row consists of two node that are possibly connected.
         B  = tf.concat([bo, bi], axis=1) # n_edges x 6, 3-> r,phi,z 
@@ -32,15 +30,7 @@ class NodeNet(tf.keras.layers.Layer):
             tf.keras.layers.Dense(hid_dim, activation='sigmoid'),
         ])
 
-    def call(self,X, e, Ri, Ro):
-        bo  = tf.matmul(Ro, X, transpose_a=True)
-        bi  = tf.matmul(Ri, X, transpose_a=True) 
-        Rwo = Ro * e[:,0]
-        Rwi = Ri * e[:,0]
-
-        # changin the order to test something !!!!!!!!! DONT FORGET TO LOOK BACK!!!
-        mi = tf.matmul(Rwi, bo)
-        mo = tf.matmul(Rwo, bi)
+    def call(self, X, mi, mo):
         # Shape of M = N_nodes x 9 (3x (3 coordinates))
         # each row consists of a node and its 2 possible neigbours
         M = tf.concat([mi, mo, X], axis=1)
@@ -57,14 +47,79 @@ class GNN(tf.keras.Model):
         self.EdgeNet  = EdgeNet(name='EdgeNet', hid_dim=GNN.config['hid_dim'])
         self.NodeNet  = NodeNet(name='NodeNet', hid_dim=GNN.config['hid_dim'])
         self.n_iters  = GNN.config['n_iters']
+        # recompute iteration internals during backprop to save memory
+        if 'checkpointing' in GNN.config.keys():
+            self.checkpointing = GNN.config['checkpointing']
+        else:
+            self.checkpointing = False
+        # stop iterating at inference once H and e change less than the tolerance
+        if 'early_exit_tol' in GNN.config.keys():
+            self.early_exit_tol = GNN.config['early_exit_tol']
+        else:
+            self.early_exit_tol = 0
+        # drop edges scoring below the threshold after every iteration at inference
+        if 'prune_threshold' in GNN.config.keys():
+            self.prune_threshold = GNN.config['prune_threshold']
+        else:
+            self.prune_threshold = 0
+        self.iterations_used = self.n_iters     # iterations of the last call
+        self.edges_used = []                    # edges of every EdgeNet pass of the last call
+
+    def iteration(self, H, X, R):
+        bo, bi = edge_features(R, H)            # end points of the edges, shared by both networks
+        e = self.EdgeNet(bo, bi)                # execute EdgeNet
+        mi, mo = aggregate(R, e, bo, bi)        # edge weighted sums at the nodes
+        H = self.NodeNet(H, mi, mo)             # execute NodeNet using the output of EdgeNet
+        return tf.concat([H,X],axis=1)          # update H with the output of NodeNet
     
-    def call(self, graph_array):
+    def adaptive_call(self, H, X, R):
+        n_edges = R.shape[2]
+        active = tf.range(n_edges)              # ids of the edges still evaluated
+        scores = tf.zeros((n_edges, 1))         # last score of every edge
+        e_prev = None
+        self.iterations_used = self.n_iters
+        self.edges_used = []
+        for i in range(self.n_iters):           # iterate until H and e have converged
+            bo, bi = edge_features(R, H)
+            e = self.EdgeNet(bo, bi)
+            self.edges_used.append(int(e.shape[0]))
+            mi, mo = aggregate(R, e, bo, bi)
+            H_next = tf.concat([self.NodeNet(H, mi, mo), X], axis=1)
+            delta = tf.reduce_max(tf.abs(H_next - H))   # largest change of node states
+            if e_prev is not None:                      # and of edge scores
+                delta = tf.maximum(delta, tf.reduce_max(tf.abs(e - e_prev)))
+            H, e_prev = H_next, e
+            if self.prune_threshold > 0:        # drop edges scoring below the threshold
+                scores = tf.tensor_scatter_nd_update(scores, active[:,None], e)
+                keep = tf.where(e[:,0] >= self.prune_threshold)[:,0]
+                active = tf.gather(active, keep)
+                R = prune_graph(R, keep)
+                e_prev = tf.gather(e, keep)
+                if active.shape[0] == 0:        # every edge is pruned
+                    self.iterations_used = i + 1
+                    return scores
+            if (i > 0) and (delta < self.early_exit_tol):
+                self.iterations_used = i + 1
+                break
+        e = self.EdgeNet(*edge_features(R, H))  # execute EdgeNet one more time to obtain edge predictions
+        self.edges_used.append(int(e.shape[0]))
+        return tf.tensor_scatter_nd_update(scores, active[:,None], e) # pruned edges keep their last score
+
+    def call(self, graph_array, training=None):
         X, Ri, Ro = graph_array                   # decompose the graph array
         H = self.InputNet(X)                    # execute InputNet to produce hidden dimensions
         H = tf.concat([H,X],axis=1)             # add new dimensions to original X matrix
+        R = stack_graph(Ri, Ro)                 # Ro and Ri are stacked once for all iterations
+        if (training is False) and ((self.early_exit_tol > 0) or (self.prune_threshold > 0)):
+            return self.adaptive_call(H, X, R)  # early exit and pruning are only used at inference
+        self.iterations_used = self.n_iters
+        self.edges_used = [Ri.shape[1]]*(self.n_iters + 1)
+        if self.checkpointing:                  # only H is kept between iterations
+            X = tf.convert_to_tensor(X)
+            iteration = tf.recompute_grad(self.iteration)
+        else:
+            iteration = self.iteration
         for i in range(self.n_iters):           # recurrent iteration of the network
-            e = self.EdgeNet(H, Ri, Ro)         # execute EdgeNet
-            H = self.NodeNet(H, e, Ri, Ro)      # execute NodeNet using the output of EdgeNet
-            H = tf.concat([H,X],axis=1) # update H with the output of NodeNet
-        e = self.EdgeNet(H, Ri, Ro)             # execute EdgeNet one more time to obtain edge predictions
+            H = iteration(H, X, R)
+        e = self.EdgeNet(*edge_features(R, H))  # execute EdgeNet one more time to obtain edge predictions
         return e                                # return edge prediction array
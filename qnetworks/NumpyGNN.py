@@ -0,0 +1,163 @@
+import json
+import numpy as np
+###############################################################################
+# Dependency-free inference runtime of exported CGNN/QGNN models.
+# Only NumPy is required, this file can be copied next to the exported
+# model and used without TensorFlow, TFQ, Cirq or sympy.
+###############################################################################
+ACTIVATIONS = {
+    'sigmoid': lambda x: 1 / (1 + np.exp(-x)),
+    'tanh'   : np.tanh,
+    'linear' : lambda x: x,
+}
+
+def apply_gate(state, matrix, qubits, n_qubits):
+    '''applies a (batched) gate to the given qubits of a batch of states'''
+    batch = state.shape[0]
+    k = len(qubits)
+    state = state.reshape((batch,) + (2,)*n_qubits)
+    # move the target qubits to the last axes
+    axes = [1+q for q in qubits]
+    state = np.moveaxis(state, axes, list(range(-k, 0)))
+    shape = state.shape
+    state = state.reshape(batch, -1, 2**k)
+    if matrix.ndim == 2:
+        state = state @ matrix.T
+    else:
+        state = np.einsum('bij,brj->bri', matrix, state)
+    state = np.moveaxis(state.reshape(shape), list(range(-k, 0)), axes)
+    return state.reshape(batch, 2**n_qubits)
+
+class NumpyGNN():
+    '''
+    Pure NumPy version of GNN.call for exported models
+
+    Fixed parts of the circuits are stored as unitaries, gates that depend
+    on the inputs are stored by their eigen decomposition. With
+    early_exit_tol > 0 the iterations stop once H and the edge scores
+    change less than the tolerance. With prune_threshold > 0 edges
+    scoring below it are dropped after every iteration and keep their
+    last score.
+    '''
+    def __init__(self, path, early_exit_tol=0, prune_threshold=0):
+        with np.load(path) as f:
+            self.arrays = dict(f.items())
+        self.spec = json.loads(str(self.arrays['spec']))
+        self.n_iters = self.spec['n_iters']
+        self.early_exit_tol = early_exit_tol
+        self.prune_threshold = prune_threshold
+        # number of iterations and edges per EdgeNet pass of the last call
+        self.iterations_used = self.n_iters
+        self.edges_used = []
+
+    def dense(self, x, layers):
+        for layer in layers:
+            x = x @ self.arrays[layer['kernel']] + self.arrays[layer['bias']]
+            x = ACTIVATIONS[layer['activation']](x)
+        return x
+
+    def simulate(self, circuit, inputs):
+        '''expectation values of the measured qubits for every input row'''
+        n_qubits = circuit['n_qubits']
+        state = np.zeros((inputs.shape[0], 2**n_qubits), dtype=np.complex128)
+        state[:,0] = 1
+        for op in circuit['ops']:
+            if op['type'] == 'fixed':
+                state = state @ self.arrays[op['matrix']].T
+            else:
+                # U = sum_k exp(i pi t (theta_k + shift)) P_k with t = a*x + b
+                t = op['a'] * inputs[:, op['input']] + op['b']
+                phases = np.exp(
+                    1j*np.pi*t[:,None]*(self.arrays[op['thetas']][None,:] + op['shift'])
+                )
+                matrix = np.einsum('bk,kij->bij', phases, self.arrays[op['projectors']])
+                state = apply_gate(state, matrix, op['qubits'], n_qubits)
+        probs = (np.abs(state)**2).reshape((inputs.shape[0],) + (2,)*n_qubits)
+        exps = []
+        for q in circuit['measured_qubits']:
+            p = probs.sum(axis=tuple(i for i in range(1, n_qubits+1) if i != q+1))
+            exps.append(p[:,0] - p[:,1])
+        return np.stack(exps, axis=1)
+
+    def block(self, name, x):
+        '''EdgeNet or NodeNet block without the message passing'''
+        spec = self.spec[name]
+        x = self.dense(x, spec['input'])
+        if spec['circuit'] is not None:
+            x = self.simulate(spec['circuit'], x * np.pi)
+        return self.dense(x, spec['output'])
+
+    def edge_features(self, H, Ri_rows, Ri_cols, Ro_rows, Ro_cols, n_edges):
+        '''features of the end points of every edge, shared by both networks'''
+        bo = np.zeros((n_edges, H.shape[1]))
+        bi = np.zeros((n_edges, H.shape[1]))
+        np.add.at(bo, Ro_cols, H[Ro_rows])
+        np.add.at(bi, Ri_cols, H[Ri_rows])
+        return bo, bi
+
+    def edge_net(self, bo, bi):
+        return self.block('EdgeNet', np.concatenate([bo, bi], axis=1))
+
+    def node_net(self, H, e, bo, bi, Ri_rows, Ri_cols, Ro_rows, Ro_cols, n_edges):
+        # the end point features are weighted by the edge scores
+        mi = np.zeros(H.shape)
+        mo = np.zeros(H.shape)
+        np.add.at(mi, Ri_rows, (e * bo)[Ri_cols])
+        np.add.at(mo, Ro_rows, (e * bi)[Ro_cols])
+        return self.block('NodeNet', np.concatenate([mi, mo, H], axis=1))
+
+    def predict(self, X, Ri_rows, Ri_cols, Ro_rows, Ro_cols):
+        '''edge predictions of a graph given as mapped X and sparse indices'''
+        X = X.astype(np.float64)
+        n_edges = Ri_rows.shape[0]
+        graph = (Ri_rows, Ri_cols, Ro_rows, Ro_cols, n_edges)
+        if self.prune_threshold > 0:
+            # input and output node of every edge, edges are pruned by id
+            in_node = np.zeros(n_edges, dtype=np.int64)
+            out_node = np.zeros(n_edges, dtype=np.int64)
+            in_node[Ri_cols] = Ri_rows
+            out_node[Ro_cols] = Ro_rows
+            active = np.arange(n_edges)
+            scores = np.zeros((n_edges, 1))
+        H = self.dense(X, self.spec['InputNet'])
+        H = np.concatenate([H, X], axis=1)
+        e_prev = None
+        self.iterations_used = self.n_iters
+        self.edges_used = []
+        for i in range(self.n_iters):
+            bo, bi = self.edge_features(H, *graph)
+            e = self.edge_net(bo, bi)
+            self.edges_used.append(graph[-1])
+            H_next = np.concatenate([self.node_net(H, e, bo, bi, *graph), X], axis=1)
+            # largest change of the node states and the edge scores
+            delta = np.abs(H_next - H).max()
+            if e_prev is not None:
+                delta = max(delta, np.abs(e - e_prev).max())
+            H, e_prev = H_next, e
+            if self.prune_threshold > 0:
+                scores[active] = e
+                keep = np.nonzero(e[:,0] >= self.prune_threshold)[0]
+                active, e_prev = active[keep], e[keep]
+                edges = np.arange(active.shape[0])
+                graph = (in_node[active], edges, out_node[active], edges, active.shape[0])
+                if active.shape[0] == 0:
+                    # every edge is pruned
+                    self.iterations_used = i + 1
+                    return scores
+            if (i > 0) and (delta < self.early_exit_tol):
+                self.iterations_used = i + 1
+                break
+        e = self.edge_net(*self.edge_features(H, *graph))
+        self.edges_used.append(graph[-1])
+        if self.prune_threshold > 0:
+            # pruned edges keep their last score
+            scores[active] = e
+            return scores
+        return e
+
+    def __call__(self, graph_array):
+        '''same interface as GNN.call with dense Ri and Ro'''
+        X, Ri, Ro = graph_array
+        Ri_rows, Ri_cols = np.nonzero(Ri)
+        Ro_rows, Ro_cols = np.nonzero(Ro)
+        return self.predict(X, Ri_rows, Ri_cols, Ro_rows, Ro_cols)
@@ -1,15 +1,133 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
 import tensorflow as tf
 import tensorflow_quantum as tfq
 import numpy as np
 import cirq
 from qcircuits.QCircuit import QCircuit
+from qnetworks.backends import init_backend, log_backend, get_expected_rows, uses_auto_backend
+from qnetworks.parameter_shift import ParameterShiftEngine
+from qnetworks.message_passing import stack_graph, edge_features, aggregate, prune_graph
 ###############################################################################
+# thread pools shared by the sharded layers of all models of the process
+shard_pools = {}
+
+def get_shard_pool(n_thread):
+    '''
+    returns the shared thread pool of n_thread threads, so that models
+    built repeatedly, e.g. by time_shards or the test workers, do not
+    start new threads for every layer
+    '''
+    if n_thread not in shard_pools:
+        shard_pools[n_thread] = ThreadPoolExecutor(n_thread)
+    return shard_pools[n_thread]
+
+def init_sharding(layer, qc_config):
+    '''sets up the thread pool of a layer if shard_size is given'''
+    if 'shard_size' in qc_config.keys():
+        layer.shard_size = qc_config['shard_size']
+    else:
+        layer.shard_size = 0
+    if layer.shard_size > 0:
+        layer.pool = get_shard_pool(GNN.config['n_thread'])
+    else:
+        layer.pool = None
+    # duration of every shard in seconds, appended by every call
+    layer.shard_times = []
+
+def init_differentiator(layer, qc_config):
+    '''sets up the batched parameter-shift engine if requested'''
+    if ('differentiator' in qc_config.keys()) and \
+            (qc_config['differentiator'] == 'batched_shift'):
+        if 'gradient_batch' in qc_config.keys():
+            gradient_batch = qc_config['gradient_batch']
+        else:
+            gradient_batch = 1024
+        layer.shift_engine = ParameterShiftEngine(layer, gradient_batch)
+    else:
+        # gradients of the differentiator of the expectation layer
+        layer.shift_engine = None
+
+def expectation(layer, circuit_data):
+    '''expectation values of the circuit of a layer for every data row'''
+    if layer.shift_engine is not None:
+        return layer.shift_engine(circuit_data)
+    if layer.repetitions==0:
+        return layer.exp_layer(
+            layer.model_circuit,
+            operators=layer.measurement_operators,
+            symbol_names=layer.symbol_names,
+            symbol_values=circuit_data
+        )
+    return layer.exp_layer(
+        layer.model_circuit,
+        operators=layer.measurement_operators,
+        symbol_names=layer.symbol_names,
+        symbol_values=circuit_data,
+        repetitions=layer.repetitions
+    )
+
+def sharded_expectation(layer, circuit_data):
+    '''
+    Evaluates the data rows in shards of shard_size rows on the thread pool
+
+    Tapes only record the ops of their own thread, so every shard records
+    its own tape and the gradients are computed shard-wise on the pool.
+    The expectations are reassembled in the order of the rows.
+    '''
+    n_rows = circuit_data.shape[0]
+    sizes = [layer.shard_size]*(n_rows//layer.shard_size)
+    if n_rows%layer.shard_size != 0:
+        sizes.append(n_rows%layer.shard_size)
+
+    def forward(shard):
+        t0 = time.time()
+        with tf.GradientTape() as tape:
+            tape.watch(shard)
+            exps = expectation(layer, shard)
+        return exps, tape, time.time() - t0
+
+    @tf.custom_gradient
+    def evaluate(circuit_data):
+        shards = tf.split(circuit_data, sizes, axis=0)
+        results = list(layer.pool.map(forward, shards))
+        if layer.record_times:
+            layer.shard_times += [t for _, _, t in results]
+
+        def backward(args):
+            (exps, tape, _), shard, upstream = args
+            return tape.gradient(exps, shard, output_gradients=upstream)
+
+        def grad(upstream):
+            upstreams = tf.split(upstream, sizes, axis=0)
+            grads = layer.pool.map(backward, zip(results, shards, upstreams))
+            return tf.concat(list(grads), axis=0)
+
+        return tf.concat([exps for exps, _, _ in results], axis=0), grad
+
+    return evaluate(circuit_data)
+
+def get_expectations(layer, circuit_data):
+    '''expectation values for every data row, sharded if requested'''
+    t0 = time.time()
+    if (layer.shard_size > 0) and (circuit_data.shape[0] > layer.shard_size):
+        exps = sharded_expectation(layer, circuit_data)
+    else:
+        exps = expectation(layer, circuit_data)
+    # measured time to compare with the cost model of the backend
+    if layer.record_times:
+        layer.backend_times.append((circuit_data.shape[0], time.time() - t0))
+    return exps
+
 class EdgeNet(tf.keras.layers.Layer):
-    def __init__(self, name='EdgeNet'):
+    def __init__(self, n_rows, name='EdgeNet'):
         super(EdgeNet, self).__init__(name=name)
 
         self.n_layers = GNN.config['EN_qc']['n_layers']
         self.n_qubits = GNN.config['EN_qc']['n_qubits']
+        self.repetitions = GNN.config['EN_qc']['repetitions']
+        # Evaluate the circuit in shards of edges on a thread pool if requested
+        init_sharding(self, GNN.config['EN_qc'])
 
         if 'dp_noise' in GNN.config['EN_qc'].keys():
             dp_noise = GNN.config['EN_qc']['dp_noise']
@@ -40,20 +158,11 @@ class EdgeNet(tf.keras.layers.Layer):
             activation='sigmoid'
         )
         
-        # Prepare PQC layer
-        if (dp_noise!=None):
-            # Noisy simulation requires density matrix simulator
-            self.exp_layer = tfq.layers.SampledExpectation(
-                cirq.DensityMatrixSimulator(noise=cirq.depolarize(dp_noise))
-            )
-        elif dp_noise==None and GNN.config['EN_qc']['repetitions']!=0:
-            # Use default simulator for noiseless execution
-            self.exp_layer = tfq.layers.SampledExpectation()
-        elif dp_noise==None and GNN.config['EN_qc']['repetitions']==0:
-            # Use default simulator for noiseless execution
-            self.exp_layer = tfq.layers.Expectation()
-        else: 
-            raise ValueError('Wrong PQC Specifications!')
+        # Prepare PQC layer, the simulation backend is selected by its
+        # estimated cost on the expected number of edges
+        init_backend(self, GNN.config, GNN.config['EN_qc'], dp_noise, 'edges', n_rows)
+        # Gradients of sampled and noisy circuits by batched parameter shifts
+        init_differentiator(self, GNN.config['EN_qc'])
 
          # Classical readout layer
         self.readout_layer = tf.keras.layers.Dense(1, activation='sigmoid')
@@ -64,12 +173,10 @@ class EdgeNet(tf.keras.layers.Layer):
             minval=0, maxval=1)*2*np.pi
         ) 
 
-    def call(self,X, Ri, Ro):
+    def call(self, bo, bi):
         '''forward pass of the edge network. '''
 
-        # Constrcu the B matrix
-        bo = tf.matmul(Ro,X,transpose_a=True)
-        bi = tf.matmul(Ri,X,transpose_a=True)
+        # Construct the B matrix from the features of the edge end points
         # Shape of B = N_edges x 6 (2x (3 + Hidden Dimension Size))
         # each row consists of two node that are connected in the input graph.
         B  = tf.concat([bo, bi], axis=1) # n_edges x 6, 3-> r,phi,z 
@@ -89,31 +196,20 @@ class EdgeNet(tf.keras.layers.Layer):
         )        
           
         # Get expectation values for all edges
-        if GNN.config['EN_qc']['repetitions']==0:
-            exps = self.exp_layer(
-                self.model_circuit,
-                operators=self.measurement_operators,
-                symbol_names=self.symbol_names,
-                symbol_values=circuit_data
-            )
-        else:
-            exps = self.exp_layer(
-                self.model_circuit,
-                operators=self.measurement_operators,
-                symbol_names=self.symbol_names,
-                symbol_values=circuit_data,
-                repetitions=GNN.config['EN_qc']['repetitions']
-            )
+        exps = get_expectations(self, circuit_data)
     
         # Return the output of the final layer
         return self.readout_layer(exps)
 
 class NodeNet(tf.keras.layers.Layer):
-    def __init__(self, name='NodeNet'):
+    def __init__(self, n_rows, name='NodeNet'):
         super(NodeNet, self).__init__(name=name)
         
         self.n_layers = GNN.config['NN_qc']['n_layers']
         self.n_qubits = GNN.config['NN_qc']['n_qubits']
+        self.repetitions = GNN.config['NN_qc']['repetitions']
+        # Evaluate the circuit in shards of nodes on a thread pool if requested
+        init_sharding(self, GNN.config['NN_qc'])
 
         if 'dp_noise' in GNN.config['EN_qc'].keys():
             dp_noise = GNN.config['EN_qc']['dp_noise']
@@ -145,20 +241,11 @@ class NodeNet(tf.keras.layers.Layer):
             activation='sigmoid'
         )
 
-        # Prepare PQC layer
-        if (dp_noise!=None):
-            # Noisy simulation requires density matrix simulator
-            self.exp_layer = tfq.layers.SampledExpectation(
-                cirq.DensityMatrixSimulator(noise=cirq.depolarize(dp_noise))
-            )
-        elif dp_noise==None and  GNN.config['EN_qc']['repetitions']!=0:
-            # Use default simulator for noiseless execution
-            self.exp_layer = tfq.layers.SampledExpectation()
-        elif dp_noise==None and  GNN.config['EN_qc']['repetitions']==0:
-            # Use default simulator for noiseless execution
-            self.exp_layer = tfq.layers.Expectation()
-        else: 
-            raise ValueError('Wrong PQC Specifications!')
+        # Prepare PQC layer, the simulation backend is selected by its
+        # estimated cost on the expected number of nodes
+        init_backend(self, GNN.config, GNN.config['NN_qc'], dp_noise, 'nodes', n_rows)
+        # Gradients of sampled and noisy circuits by batched parameter shifts
+        init_differentiator(self, GNN.config['NN_qc'])
 
         # Classical readout layer
         self.readout_layer = tf.keras.layers.Dense(
@@ -171,18 +258,11 @@ class NodeNet(tf.keras.layers.Layer):
             minval=0, maxval=1)*2*np.pi
         ) 
 
-    def call(self, X, e, Ri, Ro):
+    def call(self, X, mi, mo):
         '''forward pass of the node network. '''
 
-        # The following lines constructs the M matrix
         # M matrix contains weighted averages of input and output nodes
         # the weights are the edge probablities.
-        bo  = tf.matmul(Ro, X, transpose_a=True)
-        bi  = tf.matmul(Ri, X, transpose_a=True) 
-        Rwo = Ro * e[:,0]
-        Rwi = Ri * e[:,0]
-        mi = tf.matmul(Rwi, bo)
-        mo = tf.matmul(Rwo, bi)
         # Shape of M = N_nodes x (3x (3 + Hidden Dimension Size))
         # mi: weighted average of input nodes
         # mo: weighted average of output nodes
@@ -203,17 +283,7 @@ class NodeNet(tf.keras.layers.Layer):
         )        
 
         # Get expectation values for all nodes
-        if GNN.config['NN_qc']['repetitions']==0:
-            exps = self.exp_layer(self.model_circuit,
-                operators=self.measurement_operators,
-                symbol_names=self.symbol_names,
-                symbol_values=circuit_data)
-        else:
-            exps = self.exp_layer(self.model_circuit,
-                operators=self.measurement_operators,
-                symbol_names=self.symbol_names,
-                symbol_values=circuit_data,
-                repetitions=GNN.config['NN_qc']['repetitions'])
+        exps = get_expectations(self, circuit_data)
 
         # Return the output of the final layer
         return self.readout_layer(exps)
@@ -228,25 +298,126 @@ class GNN(tf.keras.Model):
             GNN.config['hid_dim'], input_shape=(3,),
             activation='sigmoid',name='InputNet'
         )
-        self.EdgeNet  = EdgeNet(name='EdgeNet')
-        self.NodeNet  = NodeNet(name='NodeNet')
+        # expected circuit rows are only needed to select backends by cost
+        if uses_auto_backend(GNN.config):
+            expected_rows = get_expected_rows(GNN.config)
+        else:
+            expected_rows = {'edges': None, 'nodes': None}
+        self.EdgeNet  = EdgeNet(expected_rows['edges'], name='EdgeNet')
+        self.NodeNet  = NodeNet(expected_rows['nodes'], name='NodeNet')
         self.n_iters  = GNN.config['n_iters']
+
+        # Store only H between iterations and recompute the internals of
+        # each iteration during backprop to reduce the memory usage
+        if 'checkpointing' in GNN.config.keys():
+            self.checkpointing = GNN.config['checkpointing']
+        else:
+            self.checkpointing = False
+
+        # Stop iterating at inference once H and the edge scores change
+        # less than early_exit_tol between iterations
+        if 'early_exit_tol' in GNN.config.keys():
+            self.early_exit_tol = GNN.config['early_exit_tol']
+        else:
+            self.early_exit_tol = 0
+        # Drop edges scoring below prune_threshold after every iteration
+        # at inference, later iterations only process the remaining edges
+        if 'prune_threshold' in GNN.config.keys():
+            self.prune_threshold = GNN.config['prune_threshold']
+        else:
+            self.prune_threshold = 0
+        # number of iterations and edges per EdgeNet pass of the last call
+        self.iterations_used = self.n_iters
+        self.edges_used = []
+
+    def log_backends(self, log_dir, epoch, step):
+        ''' logs the estimated and measured costs of the circuit simulations '''
+        for layer in [self.EdgeNet, self.NodeNet]:
+            log_backend(layer, log_dir, epoch, step, GNN.config['n_thread'])
+            # shard times are collected again until the next log
+            layer.shard_times = []
+
+    def iteration(self, H, X, R):
+        ''' a single EdgeNet/NodeNet iteration of the GNN '''
+        # features of the edge end points are shared by both networks
+        bo, bi = edge_features(R, H)
+        e = self.EdgeNet(bo, bi)
+        mi, mo = aggregate(R, e, bo, bi)
+        H = self.NodeNet(H, mi, mo)
+        # update H with the output of NodeNet
+        return tf.concat([H,X],axis=1)
     
-    def call(self, graph_array):
+    def adaptive_call(self, H, X, R):
+        '''
+        inference that stops iterating once H and e have converged and
+        drops edges scoring below prune_threshold after every iteration
+
+        Pruned edges keep the last score they were given.
+        '''
+        n_edges = R.shape[2]
+        # ids of the edges that are still evaluated and the last edge scores
+        active = tf.range(n_edges)
+        scores = tf.zeros((n_edges, 1))
+        e_prev = None
+        self.iterations_used = self.n_iters
+        self.edges_used = []
+        for i in range(self.n_iters):
+            bo, bi = edge_features(R, H)
+            e = self.EdgeNet(bo, bi)
+            self.edges_used.append(int(e.shape[0]))
+            mi, mo = aggregate(R, e, bo, bi)
+            H_next = tf.concat([self.NodeNet(H, mi, mo), X], axis=1)
+            # largest change of the node states and the edge scores
+            delta = tf.reduce_max(tf.abs(H_next - H))
+            if e_prev is not None:
+                delta = tf.maximum(delta, tf.reduce_max(tf.abs(e - e_prev)))
+            H, e_prev = H_next, e
+            if self.prune_threshold > 0:
+                scores = tf.tensor_scatter_nd_update(scores, active[:,None], e)
+                keep = tf.where(e[:,0] >= self.prune_threshold)[:,0]
+                active = tf.gather(active, keep)
+                R = prune_graph(R, keep)
+                e_prev = tf.gather(e, keep)
+                if active.shape[0] == 0:
+                    # every edge is pruned
+                    self.iterations_used = i + 1
+                    return scores
+            if (i > 0) and (delta < self.early_exit_tol):
+                self.iterations_used = i + 1
+                break
+        # execute EdgeNet one more time to obtain edge predictions
+        e = self.EdgeNet(*edge_features(R, H))
+        self.edges_used.append(int(e.shape[0]))
+        return tf.tensor_scatter_nd_update(scores, active[:,None], e)
+
+    def call(self, graph_array, training=None):
         ''' forward pass of the GNN '''
         # decompose the graph array
         X, Ri, Ro = graph_array
+        # circuit times are only recorded for the training cost
+        self.EdgeNet.record_times = training is not False
+        self.NodeNet.record_times = training is not False
         # execute InputNet to produce hidden dimensions
         H = self.InputNet(X)
         # add new dimensions to original X matrix
         H = tf.concat([H,X],axis=1)
+        # stack Ro and Ri once for all iterations
+        R = stack_graph(Ri, Ro)
+        # iterate until convergence and prune edges at inference if requested
+        if (training is False) and ((self.early_exit_tol > 0) or (self.prune_threshold > 0)):
+            return self.adaptive_call(H, X, R)
+        self.iterations_used = self.n_iters
+        self.edges_used = [Ri.shape[1]]*(self.n_iters + 1)
+        if self.checkpointing:
+            # recomputed functions only accept tensor inputs
+            X  = tf.convert_to_tensor(X)
+            iteration = tf.recompute_grad(self.iteration)
+        else:
+            iteration = self.iteration
         # recurrent iteration of the network
         for i in range(self.n_iters):
-            e = self.EdgeNet(H, Ri, Ro)
-            H = self.NodeNet(H, e, Ri, Ro)
-            # update H with the output of NodeNet
-            H = tf.concat([H,X],axis=1)
+            H = iteration(H, X, R)
         # execute EdgeNet one more time to obtain edge predictions
-        e = self.EdgeNet(H, Ri, Ro)
+        e = self.EdgeNet(*edge_features(R, H))
         # return edge prediction array
         return e
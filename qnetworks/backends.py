@@ -0,0 +1,255 @@
+import os
+import time
+import datetime
+import numpy as np
+import cirq
+import tensorflow_quantum as tfq
+from tools.tools import get_graph_size
+###############################################################################
+# Cost model of the circuit simulation backends of the QGNN layers
+###############################################################################
+BACKENDS = ['qsim', 'cirq', 'density_matrix', 'trajectories']
+
+# seconds per amplitude (or density matrix entry) touched by a gate, rough
+# defaults that are calibrated by a startup benchmark for auto selection
+TIME_PER_AMPLITUDE = {
+    'qsim'          : 2e-9,
+    'cirq'          : 1e-8,
+    'density_matrix': 1e-8,
+    'trajectories'  : 2e-9,
+}
+# Python overhead per gate of every circuit
+TIME_PER_GATE = {
+    'qsim'          : 0.,
+    'cirq'          : 2e-5,
+    'density_matrix': 2e-5,
+    'trajectories'  : 0.,
+}
+# backends simulating the circuits of a batch on all threads
+PARALLEL = ['qsim', 'trajectories']
+# rows of the startup benchmark that calibrates the estimated times
+BENCHMARK_ROWS = 64
+
+def get_circuit_stats(circuit, qubits, dp_noise):
+    '''number of qubits, gates, moments and noise channels of a circuit'''
+    n_qubits = len(qubits)
+    depth = len(circuit)
+    # the noise model applies a channel to every qubit after every moment
+    n_noise_ops = depth*n_qubits if dp_noise is not None else 0
+    return {
+        'n_qubits'   : n_qubits,
+        'n_gates'    : len(list(circuit.all_operations())),
+        'depth'      : depth,
+        'n_noise_ops': n_noise_ops,
+    }
+
+def get_candidates(dp_noise, repetitions):
+    '''
+    backends that are exact for the noise and the sampling of a layer,
+    analytic expectations of noisy circuits need the density matrix
+    '''
+    if dp_noise is None:
+        return ['qsim', 'cirq', 'density_matrix']
+    candidates = ['density_matrix']
+    # noisy trajectories only reproduce the noise when sampling
+    if (repetitions != 0) and hasattr(tfq.layers, 'NoisySampledExpectation'):
+        candidates.append('trajectories')
+    return candidates
+
+def estimate_backend_cost(backend, stats, n_rows, repetitions, n_thread, scale=1.):
+    '''
+    Estimates the time of a forward call on n_rows circuits in seconds
+    and the memory of the simulated states in MB, the time is multiplied
+    by the calibration scale of the backend
+    '''
+    n_qubits = stats['n_qubits']
+    n_ops = stats['n_gates']
+    if backend in ['qsim', 'cirq']:
+        size = 2**n_qubits
+    elif backend == 'density_matrix':
+        size = 4**n_qubits
+        n_ops += stats['n_noise_ops']
+    elif backend == 'trajectories':
+        # every repetition simulates a separate noisy trajectory
+        size = 2**n_qubits * max(1, repetitions)
+        n_ops += stats['n_noise_ops']
+    else:
+        raise ValueError('Backend not defined!')
+    duration = n_rows*n_ops*(size*TIME_PER_AMPLITUDE[backend] + TIME_PER_GATE[backend])
+    n_states = 1
+    if backend in PARALLEL:
+        duration /= n_thread
+        n_states = n_thread
+    # one complex64 state per simulated circuit at a time
+    memory = 8*n_states*(4**n_qubits if backend == 'density_matrix' else 2**n_qubits)
+    return scale*duration, memory / 1024**2
+
+def benchmark_backend(backend, layer, dp_noise, repetitions, n_rows=BENCHMARK_ROWS):
+    '''measured time of a forward call of a backend on random rows in seconds'''
+    exp_layer, circuit = make_exp_layer(backend, layer.model_circuit, dp_noise, repetitions)
+    rng = np.random.RandomState(0)
+    values = rng.uniform(0, 2*np.pi, (n_rows, len(layer.symbol_names))).astype(np.float32)
+    kwargs = dict(
+        operators=layer.measurement_operators,
+        symbol_names=layer.symbol_names,
+        symbol_values=values
+    )
+    if repetitions != 0:
+        kwargs['repetitions'] = repetitions
+    # the first call sets up the simulator and is not timed
+    exp_layer(circuit, **kwargs)
+    t0 = time.time()
+    exp_layer(circuit, **kwargs)
+    return time.time() - t0
+
+def calibrate_backends(layer, stats, dp_noise, repetitions, n_thread):
+    '''
+    Returns the calibration scale of every candidate backend
+
+    The constants of the cost model are rough, every candidate is timed
+    on BENCHMARK_ROWS random rows of the circuit of the layer and its
+    estimated times are scaled by the measured over the estimated time.
+    '''
+    scales = {}
+    for backend in get_candidates(dp_noise, repetitions):
+        estimate, _ = estimate_backend_cost(
+            backend, stats, BENCHMARK_ROWS, repetitions, n_thread
+        )
+        measured = benchmark_backend(backend, layer, dp_noise, repetitions)
+        scales[backend] = measured / estimate
+    return scales
+
+def uses_auto_backend(config):
+    '''True if a circuit of the config selects its backend by cost'''
+    return any(
+        ('backend' in config[name].keys()) and (config[name]['backend'] == 'auto')
+        for name in ['EN_qc', 'NN_qc']
+    )
+
+def get_expected_rows(config, n_files=10):
+    '''
+    Returns the expected edges of EdgeNet and nodes of NodeNet
+
+    expected_edges of EN_qc and expected_nodes of NN_qc are used if
+    given, otherwise the mean sizes of the first training events are
+    read. The config is not changed.
+    '''
+    expected_rows = {}
+    if 'expected_edges' in config['EN_qc'].keys():
+        expected_rows['edges'] = config['EN_qc']['expected_edges']
+    if 'expected_nodes' in config['NN_qc'].keys():
+        expected_rows['nodes'] = config['NN_qc']['expected_nodes']
+    if len(expected_rows) < 2:
+        input_dir = os.path.expandvars(config['train_dir'])
+        filenames = sorted(
+            os.path.join(input_dir, f) for f in os.listdir(input_dir)
+            if f.startswith('event') and f.endswith('.npz')
+        )[:n_files]
+        sizes = np.array([get_graph_size(f) for f in filenames])
+        expected_rows.setdefault('edges', int(sizes[:,1].mean()))
+        expected_rows.setdefault('nodes', int(sizes[:,0].mean()))
+    return expected_rows
+
+def select_backend(stats, qc_config, dp_noise, n_rows, n_thread, scales=None):
+    '''
+    Returns the backend of a layer and the estimated cost of every
+    candidate, the cheapest exact backend is selected if the backend
+    is auto. Costs are only estimated for auto, n_rows and the
+    calibration scales are not needed otherwise.
+    '''
+    repetitions = qc_config['repetitions']
+    candidates = get_candidates(dp_noise, repetitions)
+    if 'backend' not in qc_config.keys():
+        # previous selection by the noise and the repetitions
+        return ('qsim' if dp_noise is None else 'density_matrix'), {}
+    if qc_config['backend'] == 'auto':
+        costs = {
+            backend: estimate_backend_cost(
+                backend, stats, n_rows, repetitions, n_thread, scales[backend]
+            )
+            for backend in candidates
+        }
+        return min(costs, key=lambda b: costs[b][0]), costs
+    backend = qc_config['backend']
+    if backend not in candidates:
+        raise ValueError('Backend %s is not exact for this circuit!' %backend)
+    return backend, {}
+
+def make_exp_layer(backend, circuit, dp_noise, repetitions):
+    '''returns the expectation layer of a backend and the circuit it runs'''
+    if dp_noise is not None:
+        noise = cirq.depolarize(dp_noise)
+    if backend == 'qsim':
+        simulator = None
+    elif backend == 'cirq':
+        simulator = cirq.Simulator()
+    elif backend == 'density_matrix':
+        if dp_noise is not None:
+            simulator = cirq.DensityMatrixSimulator(noise=noise)
+        else:
+            simulator = cirq.DensityMatrixSimulator()
+    elif backend == 'trajectories':
+        # noise channels are part of the circuit for trajectory simulations
+        return tfq.layers.NoisySampledExpectation(), circuit.with_noise(noise)
+    else:
+        raise ValueError('Backend not defined!')
+
+    if repetitions == 0:
+        layer = tfq.layers.Expectation(backend=simulator)
+    else:
+        layer = tfq.layers.SampledExpectation(backend=simulator)
+    return layer, circuit
+
+def init_backend(layer, config, qc_config, dp_noise, rows, n_rows):
+    '''selects the backend of a QGNN layer and sets up its expectation layer'''
+    stats = get_circuit_stats(layer.model_circuit, layer.qubits, dp_noise)
+    # the cost model is calibrated by a short benchmark for auto selection
+    if ('backend' in qc_config.keys()) and (qc_config['backend'] == 'auto'):
+        layer.backend_scales = calibrate_backends(
+            layer, stats, dp_noise, qc_config['repetitions'], config['n_thread']
+        )
+    else:
+        layer.backend_scales = {}
+    backend, costs = select_backend(
+        stats, qc_config, dp_noise, n_rows, config['n_thread'], layer.backend_scales
+    )
+    layer.simulation_backend = backend
+    layer.backend_candidates = get_candidates(dp_noise, qc_config['repetitions'])
+    layer.circuit_stats = stats
+    # rows and duration of every training call since the last log,
+    # calls at inference are not recorded
+    layer.backend_times = []
+    layer.record_times = True
+    layer.exp_layer, layer.model_circuit = make_exp_layer(
+        backend, layer.model_circuit, dp_noise, qc_config['repetitions']
+    )
+    message = ': %s: %s backend selected for %d qubits, %d gates, depth %d' \
+        %(layer.name, backend, stats['n_qubits'], stats['n_gates'], stats['depth'])
+    if costs:
+        message += ', %d %s, estimates: ' %(n_rows, rows) \
+            + ', '.join('%s %.3fs %.1fMB' %(b, t, m) for b, (t, m) in costs.items())
+    print(str(datetime.datetime.now()) + message)
+
+def log_backend(layer, log_dir, epoch, step, n_thread):
+    '''logs the estimated cost of every candidate and the measured time'''
+    if len(layer.backend_times) == 0:
+        return
+    n_rows = np.mean([n for n, _ in layer.backend_times])
+    measured = np.mean([t for _, t in layer.backend_times])
+    layer.backend_times = []
+    repetitions = layer.repetitions
+
+    log_file = log_dir + 'log_backends.csv'
+    if not os.path.isfile(log_file):
+        with open(log_file, 'a') as f:
+            f.write('layer,backend,selected,n_rows,estimated_time,estimated_memory,measured_time,epoch,step\n')
+    with open(log_file, 'a') as f:
+        for backend in layer.backend_candidates:
+            estimate, memory = estimate_backend_cost(
+                backend, layer.circuit_stats, n_rows, repetitions, n_thread,
+                layer.backend_scales.get(backend, 1.)
+            )
+            selected = backend == layer.simulation_backend
+            f.write('%s, %s, %d, %f, %f, %f, %f, %d, %d\n' %(
+                layer.name, backend, selected, n_rows, estimate, memory,
+                measured if selected else np.nan, epoch, step))
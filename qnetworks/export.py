@@ -0,0 +1,132 @@
+import json
+import numpy as np
+import cirq
+import sympy
+import tensorflow as tf
+###############################################################################
+# Exports trained CGNN/QGNN models to the NumPy runtime in NumpyGNN.py
+###############################################################################
+def get_dense_layers(layer):
+    if isinstance(layer, tf.keras.Sequential):
+        return [l for l in layer.layers if isinstance(l, tf.keras.layers.Dense)]
+    return [layer]
+
+def export_dense(layer, name, arrays):
+    '''stores the weights of Dense layers and returns their spec'''
+    spec = []
+    for idx, dense in enumerate(get_dense_layers(layer)):
+        kernel, bias = dense.get_weights()
+        key = '{}/{}'.format(name, idx)
+        arrays[key + '/kernel'] = kernel
+        arrays[key + '/bias'] = bias
+        spec.append({
+            'kernel': key + '/kernel',
+            'bias': key + '/bias',
+            'activation': dense.activation.__name__,
+        })
+    return spec
+
+def get_linear_input(exponent, input_symbols):
+    '''
+    Returns (input index, a, b) for exponents of the form a*x + b
+
+    Only gates depending linearly on a single input can be exported.
+    '''
+    expr = sympy.sympify(exponent)
+    symbols = [s for s in expr.free_symbols if s.name in input_symbols]
+    if len(symbols) != 1 or len(expr.free_symbols) != 1:
+        raise ValueError('Gate depends on more than one input: ' + str(expr))
+    x = symbols[0]
+    a = sympy.diff(expr, x)
+    if len(a.free_symbols) != 0:
+        raise ValueError('Gate does not depend linearly on input: ' + str(expr))
+    return input_symbols.index(x.name), float(a), float(expr.subs(x, 0))
+
+def export_circuit(layer, name, arrays):
+    '''
+    Compiles the circuit of a QGNN layer with its trained parameters
+
+    Consecutive gates that do not depend on the inputs are fused into a
+    single unitary, input dependent gates are stored by their eigen
+    decomposition.
+    '''
+    qubits = list(layer.qubits)
+    n_inputs = len([s for s in layer.symbol_names if s.startswith('x')])
+    input_symbols = layer.symbol_names[:n_inputs]
+    theta_values = layer.params.numpy()[0]
+    resolver = cirq.ParamResolver({
+        symbol: float(value)
+        for symbol, value in zip(layer.symbol_names[n_inputs:], theta_values)
+    })
+
+    ops, fixed_ops = [], []
+    def flush():
+        if len(fixed_ops) == 0:
+            return
+        key = '{}/op{}/matrix'.format(name, len(ops))
+        arrays[key] = cirq.Circuit(fixed_ops).unitary(
+            qubit_order=qubits, qubits_that_should_be_present=qubits
+        )
+        ops.append({'type': 'fixed', 'matrix': key})
+        del fixed_ops[:]
+
+    for op in layer.model_circuit.all_operations():
+        op = cirq.resolve_parameters(op, resolver)
+        if not cirq.is_parameterized(op):
+            fixed_ops.append(op)
+            continue
+        flush()
+        gate = op.gate
+        if not isinstance(gate, cirq.EigenGate):
+            raise ValueError('Input dependent gate can not be exported: ' + str(op))
+        idx, a, b = get_linear_input(gate.exponent, input_symbols)
+        components = gate._eigen_components()
+        key = '{}/op{}'.format(name, len(ops))
+        arrays[key + '/thetas'] = np.array([c[0] for c in components])
+        arrays[key + '/projectors'] = np.array([c[1] for c in components])
+        ops.append({
+            'type': 'input',
+            'qubits': [qubits.index(q) for q in op.qubits],
+            'input': idx, 'a': a, 'b': b,
+            'shift': float(gate._global_shift),
+            'thetas': key + '/thetas',
+            'projectors': key + '/projectors',
+        })
+    flush()
+
+    # only Z measurements of single qubits are supported
+    operators = layer.measurement_operators
+    if not isinstance(operators, list):
+        operators = [operators]
+    measured_qubits = []
+    for operator in operators:
+        paulis = list(cirq.PauliString(operator).items())
+        if len(paulis) != 1 or paulis[0][1] != cirq.Z:
+            raise ValueError('Measurement can not be exported: ' + str(operator))
+        measured_qubits.append(qubits.index(paulis[0][0]))
+
+    return {'n_qubits': len(qubits), 'ops': ops, 'measured_qubits': measured_qubits}
+
+def export_model(model, config, path):
+    '''writes the trained GNN to a single npz file for NumpyGNN'''
+    arrays = {}
+    spec = {
+        'network': config['network'],
+        'n_iters': model.n_iters,
+        'InputNet': export_dense(model.InputNet, 'InputNet', arrays),
+    }
+    for name, block in [('EdgeNet', model.EdgeNet), ('NodeNet', model.NodeNet)]:
+        if config['network'] == 'CGNN':
+            spec[name] = {
+                'input': export_dense(block.layer, name, arrays),
+                'circuit': None,
+                'output': [],
+            }
+        else:
+            spec[name] = {
+                'input': export_dense(block.input_layer, name + '/input', arrays),
+                'circuit': export_circuit(block, name + '/circuit', arrays),
+                'output': export_dense(block.readout_layer, name + '/readout', arrays),
+            }
+    arrays['spec'] = np.array(json.dumps(spec))
+    np.savez(path, **arrays)
@@ -0,0 +1,39 @@
+import tensorflow as tf
+###############################################################################
+# Message passing shared by the EdgeNet and NodeNet of all GNN variants.
+# Ro and Ri are stacked once per graph, so that the features of the edge
+# end points are gathered by one matmul per iteration and are used by
+# both EdgeNet and NodeNet, and the edge weighted aggregation at the nodes
+# is a second one.
+###############################################################################
+def stack_graph(Ri, Ro):
+    '''stacks Ro and Ri of a graph, shape 2 x n_nodes x n_edges'''
+    return tf.stack([tf.convert_to_tensor(Ro), tf.convert_to_tensor(Ri)])
+
+def edge_features(R, H):
+    '''
+    features of the end points of every edge
+
+    Returns:
+        bo, bi: features of the output and the input node of every edge
+    '''
+    B = tf.matmul(R, H[None], transpose_a=True)
+    return B[0], B[1]
+
+def aggregate(R, e, bo, bi):
+    '''
+    sums the end point features weighted by the edge scores at the nodes
+
+    Weighting the edge features instead of Ri and Ro avoids the dense
+    Rwi and Rwo matrices, (Ri*e) @ bo equals Ri @ (e*bo).
+
+    Returns:
+        mi: weighted sum of the output nodes of the incoming edges
+        mo: weighted sum of the input nodes of the outgoing edges
+    '''
+    M = tf.matmul(R, tf.stack([e*bi, e*bo]))
+    return M[1], M[0]
+
+def prune_graph(R, keep):
+    '''keeps the edges with the given ids'''
+    return tf.gather(R, keep, axis=2)
@@ -0,0 +1,166 @@
+import numpy as np
+import cirq
+import sympy
+import tensorflow as tf
+###############################################################################
+# Batched parameter-shift gradients of the QGNN circuits
+###############################################################################
+def expand_circuit(circuit, symbol_names):
+    '''
+    Gives every parameterized gate of a circuit its own exponent symbol
+
+    Gate exponents have to depend linearly on a single symbol and gates
+    need two eigenvalues, which holds for the rotations and the powers
+    of CNOT/CZ/Z in circuits.py.
+
+    Returns:
+        circuit (cirq.Circuit): circuit with one symbol per gate
+        gate_symbols (list): names of the gate symbols
+        A, b (np.array): gate exponents are circuit_data @ A + b
+    '''
+    moments, columns, offsets = [], [], []
+    for moment in circuit:
+        ops = []
+        for op in moment.operations:
+            if not cirq.is_parameterized(op):
+                ops.append(op)
+                continue
+            gate = op.gate
+            if not isinstance(gate, cirq.EigenGate):
+                raise ValueError('Gate is not supported: ' + str(op))
+            thetas = sorted(set(float(c[0]) for c in gate._eigen_components()))
+            if (len(thetas) != 2) or not np.isclose(thetas[1] - thetas[0], 1):
+                raise ValueError('Gate has no two-term shift rule: ' + str(op))
+            exponent = sympy.sympify(gate.exponent)
+            if len(exponent.free_symbols) != 1:
+                raise ValueError('Gate depends on more than one symbol: ' + str(op))
+            x = list(exponent.free_symbols)[0]
+            a = sympy.diff(exponent, x)
+            if len(a.free_symbols) != 0:
+                raise ValueError('Gate does not depend linearly on its symbol: ' + str(op))
+            column = np.zeros(len(symbol_names))
+            column[symbol_names.index(x.name)] = float(a)
+            columns.append(column)
+            offsets.append(float(exponent.subs(x, 0)))
+            symbol = sympy.Symbol('g{}'.format(len(columns)-1))
+            ops.append(gate._with_exponent(symbol).on(*op.qubits))
+        moments.append(cirq.Moment(ops))
+
+    gate_symbols = ['g{}'.format(i) for i in range(len(columns))]
+    A = np.stack(columns, axis=1).astype(np.float32)
+    b = np.array(offsets, dtype=np.float32)
+    return cirq.Circuit(moments), gate_symbols, A, b
+
+class ParameterShiftEngine():
+    '''
+    Expectations of a QGNN layer with batched parameter-shift gradients
+
+    The gate exponents are a linear function of circuit_data, so TF
+    differentiates the inputs and the shared theta parameters through it
+    and the engine only differentiates gate exponents. The gradient of a
+    gate exponent t is pi/2*(f(t+1/2) - f(t-1/2)), which also holds for
+    sampled and noisy expectations. Per gradient_batch rows, the shifted
+    circuits of all gates are evaluated by a single call of the
+    expectation layer and contracted with the upstream gradient over
+    measurements at once, so no per-gate Jacobian is kept. Rows without
+    upstream gradient, e.g. edges with zero weight, are not shifted.
+    A shift batch simulates 2*n_gates*gradient_batch circuits at once,
+    gradient_batch bounds the memory of the backward pass.
+    '''
+    def __init__(self, layer, gradient_batch=1024):
+        self.layer = layer
+        self.gradient_batch = gradient_batch
+        self.circuit, self.gate_symbols, A, b = expand_circuit(
+            layer.model_circuit, layer.symbol_names
+        )
+        self.A = tf.constant(A)
+        self.b = tf.constant(b)
+        self.n_gates = len(self.gate_symbols)
+        # +-1/2 shift of every gate exponent, shape 2 x n_gates x n_gates
+        eye = np.eye(self.n_gates, dtype=np.float32)
+        self.shifts = tf.constant(np.stack([eye, -eye]) / 2)
+
+    def run(self, exponents):
+        '''expectation values for every row of gate exponents'''
+        layer = self.layer
+        if layer.repetitions == 0:
+            return layer.exp_layer(
+                self.circuit,
+                operators=layer.measurement_operators,
+                symbol_names=self.gate_symbols,
+                symbol_values=exponents
+            )
+        return layer.exp_layer(
+            self.circuit,
+            operators=layer.measurement_operators,
+            symbol_names=self.gate_symbols,
+            symbol_values=exponents,
+            repetitions=layer.repetitions
+        )
+
+    def shifted_gradient(self, exponents, upstream):
+        '''upstream weighted gradients of a batch of rows'''
+        n_rows = exponents.shape[0]
+        # all shifted circuits of the batch are evaluated at once
+        shifted = exponents[None,None,:,:] + self.shifts[:,:,None,:]
+        exps = self.run(tf.reshape(shifted, (-1, self.n_gates)))
+        exps = tf.reshape(exps, (2, self.n_gates, n_rows, -1))
+        diff = (exps[0] - exps[1]) * (np.pi/2)
+        # contract with the upstream gradient over the measurements
+        return tf.transpose(tf.einsum('grm,rm->gr', diff, upstream))
+
+    def gradient(self, exponents, upstream):
+        '''gradient of the gate exponents of all rows'''
+        # rows without upstream gradient do not contribute
+        rows = tf.where(tf.reduce_any(tf.not_equal(upstream, 0), axis=1))[:,0]
+        exponents = tf.gather(exponents, rows)
+        upstream = tf.cast(tf.gather(upstream, rows), tf.float32)
+        grads = []
+        for start in range(0, int(rows.shape[0]), self.gradient_batch):
+            end = start + self.gradient_batch
+            grads.append(self.shifted_gradient(exponents[start:end], upstream[start:end]))
+        if len(grads) == 0:
+            grads = tf.zeros((0, self.n_gates))
+        else:
+            grads = tf.concat(grads, axis=0)
+        return rows, grads
+
+    def __call__(self, circuit_data):
+        exponents = tf.matmul(circuit_data, self.A) + self.b
+
+        @tf.custom_gradient
+        def expectation(exponents):
+            def grad(upstream):
+                rows, grads = self.gradient(exponents, upstream)
+                return tf.scatter_nd(
+                    rows[:,None], grads, tf.shape(exponents, out_type=rows.dtype)
+                )
+            return self.run(exponents), grad
+
+        return expectation(exponents)
+
+def check_gradients(engine, circuit_data, eps=1e-3):
+    '''
+    Compares the engine gradients with central finite differences of
+    the sum of all expectations
+
+    Returns:
+        max_error (float): largest absolute difference
+        grads (np.array): gradient of the engine w.r.t. circuit_data
+    '''
+    circuit_data = tf.convert_to_tensor(circuit_data, dtype=tf.float32)
+    with tf.GradientTape() as tape:
+        tape.watch(circuit_data)
+        loss = tf.reduce_sum(engine(circuit_data))
+    grads = tape.gradient(loss, circuit_data).numpy()
+
+    data = circuit_data.numpy().astype(np.float64)
+    numerical = np.zeros_like(data)
+    for col in range(data.shape[1]):
+        step = np.zeros_like(data)
+        step[:,col] = eps
+        # rows are independent, so all rows are differentiated at once
+        plus = engine.run(tf.matmul(tf.constant(data + step, tf.float32), engine.A) + engine.b)
+        minus = engine.run(tf.matmul(tf.constant(data - step, tf.float32), engine.A) + engine.b)
+        numerical[:,col] = tf.reduce_sum(plus - minus, axis=1).numpy() / (2*eps)
+    return np.abs(grads - numerical).max(), grads
@@ -0,0 +1,94 @@
+'''
+Checks the batched parameter-shift gradients of the EdgeNet and NodeNet
+circuits of a QGNN config against finite differences and times them
+against the default differentiator of TFQ
+
+Analytic expectations (repetitions: 0) are used for the check, the noise
+of the config is kept. The timing uses the repetitions of the config,
+as the batched shifts are meant for sampled and noisy circuits.
+
+USAGE:
+python3 scripts/check_parameter_shift.py [PATH-TO-CONFIG-FILE] --n-rows 64
+'''
+import sys
+import os
+import time
+import copy
+import argparse
+import numpy as np
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+from tools.tools import *
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Check parameter shifts!')
+    add_arg = parser.add_argument
+    add_arg('config')
+    add_arg('--n-rows', type=int, default=64)
+    add_arg('--eps', type=float, default=1e-3)
+    add_arg('--tolerance', type=float, default=1e-2)
+    add_arg('--n-repeats', type=int, default=3)
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    config = read_config(args.config)
+    if config['network'] != 'QGNN':
+        raise ValueError('Only QGNN circuits have parameter shifts!')
+    time_config = copy.deepcopy(config)
+    for name in ['EN_qc', 'NN_qc']:
+        time_config[name]['differentiator'] = 'batched_shift'
+        config[name]['repetitions'] = 0
+        config[name]['differentiator'] = 'batched_shift'
+    tools.config = config
+
+    import tensorflow as tf
+    from qnetworks.QGNN import expectation
+    from qnetworks.parameter_shift import check_gradients
+    rng = np.random.RandomState(0)
+
+    def get_circuit_data(layer):
+        '''random inputs in [0, pi] combined with the initial parameters'''
+        n_inputs = len([s for s in layer.symbol_names if s.startswith('x')])
+        inputs = rng.uniform(0, np.pi, (args.n_rows, n_inputs))
+        params = np.repeat(layer.params.numpy(), args.n_rows, axis=0)
+        return tf.constant(np.concatenate([inputs, params], axis=1), tf.float32)
+
+    def time_gradient(layer, circuit_data):
+        '''median time of a forward and backward pass in seconds'''
+        durations = []
+        for _ in range(args.n_repeats):
+            t0 = time.time()
+            with tf.GradientTape() as tape:
+                tape.watch(circuit_data)
+                loss = tf.reduce_sum(expectation(layer, circuit_data))
+            tape.gradient(loss, circuit_data)
+            durations.append(time.time() - t0)
+        return np.median(durations)
+
+    model = build_model(config)
+    failed = False
+    for layer in [model.EdgeNet, model.NodeNet]:
+        circuit_data = get_circuit_data(layer)
+        error, _ = check_gradients(layer.shift_engine, circuit_data, args.eps)
+        print('%s: %d gates, max error: %.2e' \
+              %(layer.name, layer.shift_engine.n_gates, error))
+        failed = failed or (error > args.tolerance)
+
+    # time both differentiators on the expectation layer of the config
+    tools.config = time_config
+    model = build_model(time_config)
+    for layer in [model.EdgeNet, model.NodeNet]:
+        circuit_data = get_circuit_data(layer)
+        engine = layer.shift_engine
+        t_shift = time_gradient(layer, circuit_data)
+        layer.shift_engine = None
+        t_default = time_gradient(layer, circuit_data)
+        layer.shift_engine = engine
+        print('%s: %d rows, batched_shift: %.3fs, default: %.3fs, speedup: %.2fx' \
+              %(layer.name, args.n_rows, t_shift, t_default, t_default / t_shift))
+
+    if failed:
+        print('Gradients do not match finite differences!')
+        sys.exit(1)
+    print('Gradients match finite differences!')
@@ -0,0 +1,45 @@
+'''
+Converts a directory of event files to the compact event format
+
+USAGE:
+python3 scripts/compact_dataset.py [INPUT_DIR] [OUTPUT_DIR] --coords uint16
+'''
+import sys
+import os
+import argparse
+import datetime
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from tools.compact import get_coordinate_scale, convert_event
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Convert events to compact format!')
+    add_arg = parser.add_argument
+    add_arg('input_dir')
+    add_arg('output_dir')
+    add_arg('--coords', default='uint16', choices=['uint16', 'float16'])
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    input_dir = os.path.expandvars(args.input_dir)
+    filenames = sorted([
+        os.path.join(input_dir, f) for f in os.listdir(input_dir)
+        if f.startswith('event') and f.endswith('.npz')
+    ])
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    # quantization scale is shared by all events of the dataset
+    X_min, X_scale = None, None
+    if args.coords == 'uint16':
+        X_min, X_scale = get_coordinate_scale(filenames)
+        print('Coordinate min: ' + str(X_min) + ', scale: ' + str(X_scale))
+
+    for filename in filenames:
+        convert_event(
+            filename, args.output_dir,
+            coords=args.coords, X_min=X_min, X_scale=X_scale
+        )
+    print(
+        str(datetime.datetime.now())
+        + ': Converted %d events to %s' %(len(filenames), args.output_dir)
+        )
@@ -0,0 +1,93 @@
+'''
+Exports a trained model to the dependency-free NumPy runtime and compares
+both on a validation event
+
+The NumPy runtime is started in a fresh interpreter that only imports
+NumPy and NumpyGNN.py, so that its cold start time and peak memory are
+measured without the TF stack of this process.
+
+USAGE:
+python3 scripts/export_numpy.py [RUN_LOG_DIR] [OUTPUT_FILE]
+'''
+import sys
+import os
+import time
+import json
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from tools.tools import *
+
+# cold start of the NumPy runtime in a fresh interpreter,
+# args: runtime directory, model, event arrays, output predictions
+RUNTIME_SCRIPT = '''
+import sys, json, time, resource
+t_start = time.time()
+sys.path.insert(0, sys.argv[1])
+import numpy as np
+from NumpyGNN import NumpyGNN
+with np.load(sys.argv[3]) as f:
+    X, Ri, Ro = f['X'], f['Ri'], f['Ro']
+preds = NumpyGNN(sys.argv[2])([X, Ri, Ro])
+np.save(sys.argv[4], preds)
+# ru_maxrss is given in kilobytes on Linux
+memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+print(json.dumps({'time': time.time() - t_start, 'memory': memory}))
+'''
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Export model to NumPy!')
+    add_arg = parser.add_argument
+    add_arg('log_dir')
+    add_arg('output')
+    add_arg('--tolerance', type=float, default=1e-4)
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    log_dir = os.path.join(args.log_dir, '')
+    config = read_config(log_dir + 'config.yaml')
+    tools.config = config
+
+    # Time the TF stack until the first prediction
+    t_start = time.time()
+    from qnetworks.export import export_model
+    model = build_model(config)
+    X, Ri, Ro, y = get_dataset(config['valid_dir'], 1)[0]
+    X = map2angle(X)
+    model([X, Ri, Ro])
+    model, _ = load_params(model, log_dir)
+    preds_tf = model([X, Ri, Ro]).numpy()
+    t_tf = time.time() - t_start
+    memory_tf = get_peak_memory()
+
+    export_model(model, config, args.output)
+
+    # Time the NumPy runtime until the first prediction in a fresh process
+    runtime_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'qnetworks')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        event_file = os.path.join(tmp_dir, 'event.npz')
+        preds_file = os.path.join(tmp_dir, 'preds.npy')
+        np.savez(event_file, X=X, Ri=Ri, Ro=Ro)
+        t_start = time.time()
+        result = subprocess.run(
+            [sys.executable, '-c', RUNTIME_SCRIPT, runtime_dir, args.output,
+             event_file, preds_file],
+            stdout=subprocess.PIPE, check=True, universal_newlines=True
+        )
+        t_np_process = time.time() - t_start
+        stats_np = json.loads(result.stdout.strip().splitlines()[-1])
+        preds_np = np.load(preds_file)
+
+    error = np.abs(preds_tf - preds_np).max()
+    print('Exported model to ' + args.output)
+    print('TF stack: %.2fs, peak memory %dMB' %(t_tf, memory_tf))
+    print('NumPy runtime: %.2fs (%.2fs with interpreter start), peak memory %dMB' \
+          %(stats_np['time'], t_np_process, stats_np['memory']))
+    print('NumPy runtime uses %.1f%% of the time and %.1f%% of the memory' \
+          %(100*stats_np['time']/t_tf, 100*stats_np['memory']/memory_tf))
+    print('Max prediction difference: %.3e' %error)
+    if error > args.tolerance:
+        sys.exit('Exported model does not reproduce the predictions!')
@@ -0,0 +1,29 @@
+'''
+Updates the run database with the runs of the given studies
+
+USAGE:
+python3 scripts/index_runs.py logs/study1/ logs/study2/ --db logs/runs.sqlite
+'''
+import sys
+import os
+import time
+import argparse
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from tools.rundb import RunDatabase
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Index log directories!')
+    add_arg = parser.add_argument
+    add_arg('studies', nargs='+')
+    add_arg('--db', default='logs/runs.sqlite')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    t_start = time.time()
+    db = RunDatabase(args.db)
+    n_updated = db.update(args.studies)
+    n_skipped, n_removed = db.n_skipped, db.n_removed
+    db.close()
+    print('Updated %d files in %.2fs, skipped %d incomplete rows, removed %d deleted runs' \
+          %(n_updated, time.time() - t_start, n_skipped, n_removed))
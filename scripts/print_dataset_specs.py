@@ -0,0 +1,24 @@
+'''
+Prints the statistics of a dataset and caches them next to the events
+
+USAGE:
+python3 scripts/print_dataset_specs.py [INPUT_DIR] --n_workers 4
+'''
+import sys
+import os
+import argparse
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from tools.dataset_specs import get_dataset_specs
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Print dataset specs!')
+    add_arg = parser.add_argument
+    add_arg('input_dir')
+    add_arg('--n_workers', type=int, default=None)
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    specs = get_dataset_specs(args.input_dir, args.n_workers)
+    for key in specs:
+        print(key + ': ' + str(specs[key]))
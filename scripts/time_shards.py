@@ -0,0 +1,64 @@
+'''
+Times the circuit evaluation of a QGNN config for different shard sizes,
+to pick the shard_size of EN_qc and NN_qc for a machine
+
+USAGE:
+python3 scripts/time_shards.py [PATH-TO-CONFIG-FILE] --shard-sizes 0 256 1024
+'''
+import sys
+import os
+import time
+import argparse
+import numpy as np
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+from tools.tools import *
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Time circuit shards!')
+    add_arg = parser.add_argument
+    add_arg('config')
+    add_arg('--shard-sizes', type=int, nargs='+', default=[0, 256, 1024, 4096])
+    add_arg('--n-repeats', type=int, default=3)
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    config = read_config(args.config)
+    if config['network'] != 'QGNN':
+        raise ValueError('Only QGNN circuits can be sharded!')
+    tools.config = config
+
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(config['n_thread'])
+    tf.config.threading.set_inter_op_parallelism_threads(config['n_thread'])
+
+    X, Ri, Ro, y = get_dataset(config['valid_dir'], 1)[0]
+    X = map2angle(X)
+    print('Event with %d nodes and %d edges' %(X.shape[0], y.shape[0]))
+
+    for shard_size in args.shard_sizes:
+        config['EN_qc']['shard_size'] = shard_size
+        config['NN_qc']['shard_size'] = shard_size
+        model = build_model(config)
+        model([X, Ri, Ro])
+
+        durations, shard_times = [], {'EdgeNet': [], 'NodeNet': []}
+        for _ in range(args.n_repeats):
+            # shards of all EdgeNet and NodeNet calls of the event
+            model.EdgeNet.shard_times = []
+            model.NodeNet.shard_times = []
+            t0 = time.time()
+            with tf.GradientTape() as tape:
+                loss = tf.reduce_mean(model([X, Ri, Ro]))
+            tape.gradient(loss, model.trainable_variables)
+            durations.append(time.time() - t0)
+            shard_times['EdgeNet'] += model.EdgeNet.shard_times
+            shard_times['NodeNet'] += model.NodeNet.shard_times
+
+        print('shard_size: %d, forward and backward: %.3fs' \
+              %(shard_size, np.median(durations)))
+        for name, times in shard_times.items():
+            if len(times) > 0:
+                print('    %s: %d shards per event, mean: %.4fs, max: %.4fs' \
+                      %(name, len(times)//args.n_repeats, np.mean(times), np.max(times)))
@@ -0,0 +1,61 @@
+'''
+Compares a compact dataset with the original one and reports the size
+reduction and the maximal coordinate error
+
+USAGE:
+python3 scripts/verify_compact_dataset.py [ORIGINAL_DIR] [COMPACT_DIR]
+'''
+import sys
+import os
+import argparse
+import numpy as np
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from tools.compact import is_compact, compact_to_sparse
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Verify compact events!')
+    add_arg = parser.add_argument
+    add_arg('original_dir')
+    add_arg('compact_dir')
+    return parser.parse_args()
+
+def read_arrays(filename):
+    with np.load(filename) as f:
+        arrays = dict(f.items())
+    if is_compact(arrays):
+        arrays = compact_to_sparse(**arrays)
+    return arrays
+
+if __name__ == '__main__':
+    args = parse_args()
+    filenames = sorted([
+        f for f in os.listdir(args.original_dir)
+        if f.startswith('event') and f.endswith('.npz')
+    ])
+
+    size_original, size_compact = 0, 0
+    max_error = np.zeros(3)
+    n_mismatch = 0
+    for f in filenames:
+        original_file = os.path.join(args.original_dir, f)
+        compact_file  = os.path.join(args.compact_dir, f)
+        size_original += os.path.getsize(original_file)
+        size_compact  += os.path.getsize(compact_file)
+
+        original = read_arrays(original_file)
+        compact  = read_arrays(compact_file)
+        error = np.abs(original['X'] - compact['X']).max(axis=0)
+        max_error = np.maximum(max_error, error)
+        # indices and labels have to be lossless
+        for key in ['Ri_rows', 'Ri_cols', 'Ro_rows', 'Ro_cols', 'y']:
+            if not np.array_equal(original[key], compact[key]):
+                n_mismatch += 1
+                print('Mismatch in %s of %s' %(key, f))
+
+    print('Number of events: %d' %len(filenames))
+    print('Original size: %.2f MB' %(size_original/1e6))
+    print('Compact size:  %.2f MB' %(size_compact/1e6))
+    print('Size reduction: %.2f%%' %(100*(1-size_compact/size_original)))
+    print('Max coordinate error (r, phi, z): %.3e, %.3e, %.3e' %tuple(max_error))
+    if n_mismatch:
+        sys.exit('Found %d lossy index or label arrays!' %n_mismatch)
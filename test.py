@@ -2,65 +2,262 @@ import sys
 import os
 import time
 import datetime
+import multiprocessing
 import numpy as np
 from sklearn import metrics
 from tools.tools import *
+from tools.predictions import PredictionWriter
+from tools.memory import get_admission_control
+from tools.subgraph import split_edges
 import tensorflow as tf
 
-def test(config, model, test_type):
+def get_subsample(n_test, subsample, seed=0):
+    '''fixed random subset of event indices used for quick checks'''
+    if (subsample is None) or (subsample <= 0) or (subsample >= n_test):
+        return list(range(n_test))
+    rng = np.random.RandomState(seed)
+    return sorted(rng.choice(n_test, subsample, replace=False))
+
+def get_prune_reference(config):
+    '''True if the unpruned predictions are computed to compare the AUC'''
+    if ('prune_reference' in config.keys()) and config['prune_reference']:
+        return ('prune_threshold' in config.keys()) and config['prune_threshold'] > 0
+    return False
+
+def predict_event(model, X, Ri, Ro, reference=False):
+    '''
+    predictions of an event and the statistics of the inference
+
+    stats holds the iterations and the edges of every EdgeNet pass, and
+    the predictions without early exit and pruning if reference is set
+    '''
+    preds = model([X, Ri, Ro], training=False)
+    stats = {'iterations': model.iterations_used, 'edges': list(model.edges_used)}
+    if reference:
+        stats['reference'] = model([X, Ri, Ro]).numpy()
+    return preds, stats
+
+def load_admitted(filename, admission=None):
+    '''
+    loads an event within the memory budget of the evaluation
+
+    Returns:
+        graphs (list): graphs of the event, its phi sectors if it is split
+        edges (list): edge ids of every graph, None if it is not split
+        y: labels of all edges of the event, None if it is skipped
+    '''
+    arrays = load_sparse(filename)
+    if admission is None:
+        return [sparse_to_graph(**arrays)], None, arrays['y']
+    # no gradient tape is recorded, low_memory events fit without checkpointing
+    parts, _ = admission(arrays, filename, log=False)
+    if len(parts) == 0:
+        return [], None, None
+    graphs = [sparse_to_graph(**part) for part in parts]
+    if len(parts) == 1:
+        return graphs, None, arrays['y']
+    return graphs, split_edges(**arrays, n_parts=len(parts)), arrays['y']
+
+def predict_admitted(model, graphs, edges, reference=False):
+    '''
+    predictions and statistics of an event from those of its parts,
+    the predictions are put back in the order of the edges of the event
+    '''
+    if edges is None:
+        X, Ri, Ro, _ = graphs[0]
+        return predict_event(model, map2angle(X), Ri, Ro, reference)
+    n_edges = sum(ids.shape[0] for ids in edges)
+    preds = np.zeros((n_edges, 1), dtype=np.float32)
+    stats = {'iterations': 0, 'edges': []}
+    if reference:
+        stats['reference'] = np.zeros((n_edges, 1), dtype=np.float32)
+    for (X, Ri, Ro, _), ids in zip(graphs, edges):
+        preds_, stats_ = predict_event(model, map2angle(X), Ri, Ro, reference)
+        preds[ids] = preds_.numpy().reshape(-1, 1)
+        stats['iterations'] = max(stats['iterations'], stats_['iterations'])
+        # parts that exit early evaluate no edges in the later passes
+        for n, n_pass in enumerate(stats_['edges']):
+            if n < len(stats['edges']):
+                stats['edges'][n] += n_pass
+            else:
+                stats['edges'].append(n_pass)
+        if reference:
+            stats['reference'][ids] = stats_['reference'].reshape(-1, 1)
+    return tf.convert_to_tensor(preds), stats
+
+def test(config, model, test_type, epoch=0, step=0, subsample=None, pool=None,
+         admission=None):
+    test_models([config], [model], test_type, epoch, step, subsample, pool,
+                admission)
+
+def test_models(configs, models, test_type, epoch=0, step=0, subsample=None,
+                pool=None, admission=None):
+    '''
+    evaluates multiple models while every event is loaded only once
+
+    if a TestPool is given, the events are evaluated by its workers,
+    which apply their own admission. Events are split or skipped by the
+    AdmissionControl of the evaluation, skipped events are left out of
+    the metrics.
+    '''
+    # data settings are shared by all models
+    config = configs[0]
+
+    # load data
+    if test_type == 'valid':
+        input_dir = config['valid_dir']
+        n_test = config['n_valid']
+    elif test_type == 'train':
+        input_dir = config['train_dir']
+        n_test = config['n_train']
+    valid_data = get_dataset(input_dir, n_test)
+
+    # evaluate on all events or on a fixed random subsample
+    test_list = get_subsample(n_test, subsample)
+
     print(
         str(datetime.datetime.now()) 
         + ' Starting testing the %s set with '%(test_type)
-        + str(config['n_valid']) + ' subgraphs!'
+        + str(len(test_list)) + ' subgraphs!'
         )
 
     # Start timer
     t_start = time.time()
-    
-    # load data
+
+    # Obtain predictions and labels
+    preds   = [[] for _ in models]
+    stats   = [[] for _ in models]
+    labels  = []
+    n_edges = []
+    filenames = []
+    references = [get_prune_reference(model_config) for model_config in configs]
+    if pool is not None:
+        for n, model in enumerate(models):
+            preds[n], labels, stats[n], filenames = pool.predict(
+                model, input_dir, n_test, test_list, references[n]
+            )
+        n_edges = [y.shape[0] for y in labels]
+    else:
+        for idx in test_list:
+
+            filename = valid_data.filenames[idx]
+            graphs, edges, y = load_admitted(filename, admission)
+            if y is None:
+                continue
+            filenames.append(filename)
+            n_edges.append(y.shape[0])
+            labels.append(y)
+
+            for n, model in enumerate(models):
+                preds_, stats_ = predict_admitted(model, graphs, edges, references[n])
+                preds[n].append(preds_)
+                stats[n].append(stats_)
+
+    n_skipped = len(test_list) - len(filenames)
+    if n_skipped > 0:
+        print(
+            str(datetime.datetime.now())
+            + ' Skipped %d subgraphs that exceed the memory budget!' %n_skipped
+            )
+    if len(filenames) == 0:
+        return
+
+    labels = np.concatenate(labels).reshape(-1, 1)
+
+    # time spent on the predictions is shared by all models
+    duration = time.time() - t_start
+
+    for model_config, preds_, stats_ in zip(configs, preds, stats):
+        preds_ = tf.concat(preds_, axis=0).numpy()
+        log_test_results(
+            model_config, test_type, preds_, labels, filenames, n_edges,
+            epoch, step, duration, stats_
+        )
+
+def log_pruning(config, log_extension, stats, labels, auc, epoch, step):
+    '''
+    logs the mean fraction of edges evaluated by every EdgeNet pass and
+    the AUC with and without pruning if the reference is computed
+    '''
+    n_passes = config['n_iters'] + 1
+    fractions = np.zeros((len(stats), n_passes))
+    for n, stats_ in enumerate(stats):
+        # passes skipped by the early exit evaluate no edges
+        edges = stats_['edges'][:n_passes]
+        fractions[n, :len(edges)] = np.array(edges) / stats_['edges'][0]
+    fractions = fractions.mean(axis=0)
+    if 'reference' in stats[0].keys():
+        reference = np.concatenate([s['reference'] for s in stats])
+        fpr, tpr, _ = metrics.roc_curve(labels.astype(int), reference, pos_label=1)
+        auc_reference = metrics.auc(fpr, tpr)
+    else:
+        auc_reference = np.nan
+
+    log_file = config['log_dir'] + 'log_pruning_' + log_extension + '.csv'
+    if not os.path.isfile(log_file):
+        with open(log_file, 'a') as f:
+            f.write('auc,auc_unpruned,'
+                    + ','.join('edges_%d' %i for i in range(n_passes))
+                    + ',epoch,step\n')
+    with open(log_file, 'a') as f:
+        f.write('%f, %f, ' %(auc, auc_reference)
+                + ', '.join('%f' %x for x in fractions)
+                + ', %d, %d\n' %(epoch, step))
+    print(
+        str(datetime.datetime.now()) + ': ' + log_extension
+        + ' Test: Edges per pass: ' + ' '.join('%.2f' %x for x in fractions)
+        + ', AUC unpruned: %.4f' %auc_reference
+        )
+
+def log_iterations(config, log_extension, filenames, iterations, epoch, step):
+    '''logs the message passing iterations used for every event'''
+    log_file = config['log_dir'] + 'log_iterations_' + log_extension + '.csv'
+    if not os.path.isfile(log_file):
+        with open(log_file, 'a') as f:
+            f.write('filename,iterations,epoch,step\n')
+    with open(log_file, 'a') as f:
+        for filename, n_iters in zip(filenames, iterations):
+            f.write('%s, %d, %d, %d\n' %(os.path.basename(filename), n_iters, epoch, step))
+    print(
+        str(datetime.datetime.now()) + ': ' + log_extension
+        + ' Test: Mean iterations: %.2f of %d' %(np.mean(iterations), config['n_iters'])
+        )
+
+def log_test_results(config, test_type, preds, labels, filenames, n_edges,
+                     epoch, step, duration, stats=None):
+    '''calculates the metrics of the predictions and logs them'''
+    # Start timer
+    t_start = time.time()
+
     if test_type == 'valid':
-        valid_data = get_dataset(config['valid_dir'], config['n_valid'])
-        n_test = config['n_valid']
         log_extension = 'validation'
     elif test_type == 'train':
-        valid_data = get_dataset(config['train_dir'], config['n_train'])
-        n_test = config['n_train']
         log_extension = 'training'
 
     # Load loss function
     loss_fn = getattr(tf.keras.losses, config['loss_func'])()
 
-    # Obtain predictions and labels
-    for n in range(n_test):
-
-        X, Ri, Ro, y = valid_data[n]
-
-        if n == 0:
-            preds = model([map2angle(X), Ri, Ro])
-            labels = y
-        else:	
-            out = model([map2angle(X), Ri, Ro])
-            preds  = tf.concat([preds, out], axis=0)
-            labels = tf.concat([labels, y], axis=0)
-
-    labels = tf.reshape(labels, shape=(labels.shape[0],1))
-
     # calculate weight for each edge to avoid class imbalance
     weights = tf.convert_to_tensor(true_fake_weights(labels))
 
     loss = loss_fn(labels, preds, sample_weight=weights).numpy()
 
-    # Log all predictons (takes some considerable time - use only for debugging)
-    if config['log_verbosity']>=3 and test_type=='valid':	
-        with open(config['log_dir']+'log_validation_preds.csv', 'a') as f:
-            for i in range(len(preds)):
-                f.write('%.4f, %.4f\n' %(preds[i],labels[i]))
+    # Log all predictons to the binary prediction store
+    if ('log_predictions' in config.keys()) and config['log_predictions']:
+        log_predictions = True
+    else:
+        log_predictions = config['log_verbosity']>=3
+    if log_predictions and test_type=='valid':
+        if 'predictions_dtype' in config.keys():
+            dtype = config['predictions_dtype']
+        else:
+            dtype = 'float16'
+        writer = PredictionWriter(config['log_dir'], 'predictions_valid', dtype)
+        writer.write(epoch, step, filenames, preds, labels, n_edges)
 
     # Calculate Metrics
     # To Do: add 0.8 threshold and other possible metrics
     # efficency, purity etc.
-    labels = labels.numpy()
-    preds  = preds.numpy()
 
     #n_edges = labels.shape[0]
     #n_class = [n_edges - sum(labels), sum(labels)]
@@ -93,14 +290,146 @@ def test(config, model, test_type):
     f1_7        = (2*precision_7*recall_7)/(precision_7+recall_7) 
 
     # End timer
-    duration = time.time() - t_start
+    duration += time.time() - t_start
 
     # Log Metrics
     with open(config['log_dir']+'log_'+log_extension+'.csv', 'a') as f:
-        f.write('%f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %d\n' %(accuracy_5, auc, loss, precision_5, accuracy_3, precision_3, recall_3, f1_3, accuracy_5, precision_5, recall_5, f1_5, accuracy_7, precision_7, recall_7, f1_7, duration))
+        f.write('%f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %d, %d, %d\n' %(accuracy_5, auc, loss, precision_5, accuracy_3, precision_3, recall_3, f1_3, accuracy_5, precision_5, recall_5, f1_5, accuracy_7, precision_7, recall_7, f1_7, duration, epoch, step))
+
+    # Log the iterations of every event if the early exit is used
+    if ('early_exit_tol' in config.keys()) and config['early_exit_tol'] > 0 \
+            and (stats is not None):
+        iterations = [stats_['iterations'] for stats_ in stats]
+        log_iterations(config, log_extension, filenames, iterations, epoch, step)
+
+    # Log the edges of every iteration and the AUC impact of pruning
+    if ('prune_threshold' in config.keys()) and config['prune_threshold'] > 0 \
+            and (stats is not None):
+        log_pruning(config, log_extension, stats, labels, auc, epoch, step)
 
     # Print summary
     print(str(datetime.datetime.now()) + ': ' + log_extension+' Test:  Loss: %.4f,  AUC: %.4f, Acc: %.4f,  Precision: %.4f -- Elapsed: %dm%ds' %(loss, auc, accuracy_5*100, precision_5, duration/60, duration%60))
 
     del labels
     del preds
+
+def test_worker(config, queue):
+    '''rebuilds the model and evaluates the weight snapshots in the queue'''
+    tools.config = config
+    tf.config.threading.set_intra_op_parallelism_threads(config['n_thread'])
+    tf.config.threading.set_inter_op_parallelism_threads(config['n_thread'])
+
+    # build the model by executing it on an example graph
+    model = build_model(config)
+    X, Ri, Ro, y = get_dataset(config['train_dir'], 1)[0]
+    model([map2angle(X), Ri, Ro])
+    admission = get_admission_control(config, n_graphs=1)
+
+    while True:
+        job = queue.get()
+        # None is sent by the trainer when training is completed
+        if job is None:
+            break
+        weights, epoch, step, subsample = job
+        model.set_weights(weights)
+        if config['n_valid']:
+            test(config, model, 'valid', epoch, step, subsample, admission=admission)
+        if config['n_train']:
+            test(config, model, 'train', epoch, step, subsample, admission=admission)
+
+class AsyncTester():
+    '''Evaluates weight snapshots in a background process during training'''
+    def __init__(self, config):
+        # TF is not fork safe, the worker starts from a fresh interpreter
+        context = multiprocessing.get_context('spawn')
+        self.queue = context.Queue()
+        self.process = context.Process(
+            target=test_worker, args=(config, self.queue), daemon=True
+        )
+        self.process.start()
+
+    def submit(self, model, epoch, step, subsample=None):
+        '''hands a snapshot of the current weights to the worker'''
+        self.queue.put((model.get_weights(), epoch, step, subsample))
+
+    def pending(self):
+        '''number of snapshots waiting for the worker, 0 if unknown'''
+        try:
+            return self.queue.qsize()
+        except NotImplementedError:
+            # qsize is not available on macOS
+            return 0
+
+    def close(self):
+        '''waits for all submitted evaluations to finish'''
+        self.queue.put(None)
+        self.process.join()
+
+# model and admission control of a TestPool worker process
+worker_state = {}
+
+def init_pool_worker(config, n_thread):
+    '''builds the model of a TestPool worker'''
+    tools.config = config
+    tf.config.threading.set_intra_op_parallelism_threads(n_thread)
+    tf.config.threading.set_inter_op_parallelism_threads(n_thread)
+    model = build_model(config)
+    X, Ri, Ro, y = get_dataset(config['train_dir'], 1)[0]
+    model([map2angle(X), Ri, Ro])
+    worker_state['model'] = model
+    worker_state['admission'] = get_admission_control(config, n_graphs=1)
+
+def predict_shard(job):
+    '''predictions and labels of a shard of events, skipped events are left out'''
+    weights, input_dir, n_files, shard, reference = job
+    model = worker_state['model']
+    model.set_weights(weights)
+    data = get_dataset(input_dir, n_files)
+    results = []
+    for idx in shard:
+        graphs, edges, y = load_admitted(data.filenames[idx], worker_state['admission'])
+        if y is None:
+            continue
+        preds, stats = predict_admitted(model, graphs, edges, reference)
+        results.append((preds.numpy(), y, stats, data.filenames[idx]))
+    return results
+
+class TestPool():
+    '''
+    Evaluates the events of test() in parallel worker processes
+
+    Every worker holds a copy of the model and receives the current
+    weights with each shard, results are merged in the order of the
+    events so that the metrics do not depend on the number of workers.
+    '''
+    def __init__(self, config, n_workers):
+        self.n_workers = n_workers
+        # share the threads of the process between the workers
+        n_thread = max(1, config['n_thread']//n_workers)
+        # TF is not fork safe, the workers start from a fresh interpreter
+        context = multiprocessing.get_context('spawn')
+        self.pool = context.Pool(
+            n_workers, initializer=init_pool_worker, initargs=(config, n_thread)
+        )
+
+    def predict(self, model, input_dir, n_files, test_list, reference=False):
+        '''
+        returns per-event predictions, labels, inference statistics and
+        filenames of the admitted events in the order of test_list
+        '''
+        weights = model.get_weights()
+        n_shards = min(len(test_list), 2*self.n_workers)
+        shards = [list(shard) for shard in np.array_split(test_list, n_shards)]
+        results = self.pool.map(
+            predict_shard,
+            [(weights, input_dir, n_files, shard, reference) for shard in shards]
+        )
+        preds  = [tf.convert_to_tensor(p) for shard in results for p, _, _, _ in shard]
+        labels = [y for shard in results for _, y, _, _ in shard]
+        stats  = [s for shard in results for _, _, s, _ in shard]
+        filenames = [f for shard in results for _, _, _, f in shard]
+        return preds, labels, stats, filenames
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
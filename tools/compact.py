@@ -0,0 +1,96 @@
+import numpy as np
+import os
+
+# Version tag stored inside every compact event file
+COMPACT_FORMAT = 'compact_v1'
+
+def index_dtype(max_value):
+    '''smallest unsigned integer type that can hold indices up to max_value'''
+    if max_value < 2**16:
+        return np.uint16
+    return np.uint32
+
+def get_coordinate_scale(filenames, n_levels=2**16-1):
+    '''
+    Calculates the per-dataset quantization scale of the coordinates
+
+    Returns:
+        X_min (array): minimum value of each coordinate over all events
+        X_scale (array): step size of each coordinate for n_levels
+    '''
+    X_min, X_max = None, None
+    for filename in filenames:
+        with np.load(filename) as f:
+            X = f['X']
+        if X_min is None:
+            X_min, X_max = X.min(axis=0), X.max(axis=0)
+        else:
+            X_min = np.minimum(X_min, X.min(axis=0))
+            X_max = np.maximum(X_max, X.max(axis=0))
+    X_scale = (X_max - X_min) / n_levels
+    # avoid division by zero for constant coordinates
+    X_scale[X_scale == 0] = 1.
+    return X_min.astype(np.float32), X_scale.astype(np.float32)
+
+def sparse_to_compact(X, Ri_rows, Ri_cols, Ro_rows, Ro_cols, y,
+                      coords='uint16', X_min=None, X_scale=None):
+    '''
+    Encodes a sparse graph to the compact event format
+
+    coords='uint16' quantizes the coordinates with the per-dataset
+    X_min and X_scale, coords='float16' stores half precision coordinates.
+    Indices and labels are stored losslessly.
+    '''
+    n_nodes, n_edges = X.shape[0], y.shape[0]
+    if not np.all((y == 0) | (y == 1)):
+        raise ValueError('Only binary labels can be bit-packed!')
+
+    compact = {
+        'format' : np.array(COMPACT_FORMAT),
+        'n_edges': np.array(n_edges, dtype=np.int64),
+        'y_bits' : np.packbits(y.astype(np.uint8)),
+        'Ri_rows': Ri_rows.astype(index_dtype(n_nodes)),
+        'Ro_rows': Ro_rows.astype(index_dtype(n_nodes)),
+        'Ri_cols': Ri_cols.astype(index_dtype(n_edges)),
+        'Ro_cols': Ro_cols.astype(index_dtype(n_edges)),
+    }
+
+    if coords == 'uint16':
+        if X_min is None or X_scale is None:
+            raise ValueError('uint16 coordinates require X_min and X_scale!')
+        X_q = np.rint((X - X_min) / X_scale)
+        compact['X_q']     = np.clip(X_q, 0, 2**16-1).astype(np.uint16)
+        compact['X_min']   = np.asarray(X_min, dtype=np.float32)
+        compact['X_scale'] = np.asarray(X_scale, dtype=np.float32)
+    elif coords == 'float16':
+        compact['X_f16'] = X.astype(np.float16)
+    else:
+        raise ValueError('Coordinate format not defined!')
+
+    return compact
+
+def compact_to_sparse(n_edges, y_bits, Ri_rows, Ri_cols, Ro_rows, Ro_cols,
+                      X_q=None, X_min=None, X_scale=None, X_f16=None,
+                      **kwargs):
+    '''Decodes a compact event back to the arrays of the sparse format'''
+    if X_q is not None:
+        X = X_min + X_q.astype(np.float32) * X_scale
+    else:
+        X = X_f16.astype(np.float32)
+    y = np.unpackbits(y_bits, count=int(n_edges)).astype(np.float32)
+    return dict(
+        X=X.astype(np.float32), y=y,
+        Ri_rows=Ri_rows.astype(np.int64), Ri_cols=Ri_cols.astype(np.int64),
+        Ro_rows=Ro_rows.astype(np.int64), Ro_cols=Ro_cols.astype(np.int64),
+    )
+
+def is_compact(arrays):
+    return 'format' in arrays and str(arrays['format']) == COMPACT_FORMAT
+
+def convert_event(filename, output_dir, **kwargs):
+    '''Writes the compact version of a single event file to output_dir'''
+    with np.load(filename) as f:
+        compact = sparse_to_compact(**dict(f.items()), **kwargs)
+    output = os.path.join(output_dir, os.path.basename(filename))
+    np.savez_compressed(output, **compact)
+    return output
@@ -0,0 +1,125 @@
+import os
+import json
+import datetime
+import multiprocessing
+import numpy as np
+from tools.tools import load_sparse, GraphDataset
+
+# Name of the cache file written next to the event files
+SPECS_FILE = 'dataset_specs.json'
+
+def scan_event(filename):
+    '''statistics of a single event file'''
+    arrays = load_sparse(filename)
+    X, y = arrays['X'], arrays['y']
+    stat = os.stat(filename)
+    return {
+        'mtime'  : stat.st_mtime,
+        'size'   : stat.st_size,
+        'n_nodes': int(X.shape[0]),
+        'n_edges': int(y.shape[0]),
+        'n_true' : int(y.sum()),
+        'X_min'  : X.min(axis=0).tolist(),
+        'X_max'  : X.max(axis=0).tolist(),
+    }
+
+def scan_events(filenames, n_workers=None):
+    '''scans the event files in parallel with a process pool'''
+    if len(filenames) == 0:
+        return []
+    if n_workers == 1:
+        return [scan_event(f) for f in filenames]
+    # TF is not fork safe, workers start from a fresh interpreter
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(n_workers) as pool:
+        return pool.map(scan_event, filenames, chunksize=8)
+
+def get_event_specs(input_dir, n_workers=None, n_files=None):
+    '''
+    Per-event statistics of the events in input_dir
+
+    Only the first n_files events in the order of GraphDataset are used
+    if n_files is given, e.g. the n_train events of training. Statistics
+    are cached in input_dir/dataset_specs.json and only new or modified
+    event files are scanned again.
+    '''
+    input_dir = os.path.expandvars(input_dir)
+    cache_file = os.path.join(input_dir, SPECS_FILE)
+    all_events = sorted([f for f in os.listdir(input_dir)
+                         if f.startswith('event') and f.endswith('.npz')])
+    events = sorted(os.path.basename(f)
+                    for f in GraphDataset(input_dir, n_files).filenames)
+
+    cache = {}
+    if os.path.isfile(cache_file):
+        with open(cache_file, 'r') as f:
+            cache = json.load(f)
+
+    # rescan files whose modification time or size changed
+    outdated = []
+    for event in events:
+        stat = os.stat(os.path.join(input_dir, event))
+        if (event not in cache) or (cache[event]['mtime'] != stat.st_mtime) \
+                or (cache[event]['size'] != stat.st_size):
+            outdated.append(event)
+
+    if len(outdated) > 0 or set(cache) - set(all_events):
+        print(
+            str(datetime.datetime.now())
+            + ': Scanning %d events in %s' %(len(outdated), input_dir)
+            )
+        specs = scan_events(
+            [os.path.join(input_dir, event) for event in outdated], n_workers
+        )
+        cache.update(zip(outdated, specs))
+        # events that were deleted are removed from the cache
+        cache = {event: cache[event] for event in all_events if event in cache}
+        try:
+            with open(cache_file, 'w') as f:
+                json.dump(cache, f)
+        except OSError:
+            print('Could not write dataset specs to ' + cache_file)
+    return {event: cache[event] for event in events}
+
+def summarize_specs(event_specs):
+    '''aggregates per-event statistics to the dataset statistics'''
+    n_nodes = np.array([s['n_nodes'] for s in event_specs.values()])
+    n_edges = np.array([s['n_edges'] for s in event_specs.values()])
+    n_true  = sum([s['n_true'] for s in event_specs.values()])
+    n_fake  = n_edges.sum() - n_true
+    return {
+        'n_events'     : len(event_specs),
+        'n_true'       : int(n_true),
+        'n_fake'       : int(n_fake),
+        'class_weights': get_class_weights(n_fake, n_true),
+        'n_nodes'      : distribution(n_nodes),
+        'n_edges'      : distribution(n_edges),
+        'X_min'        : np.min([s['X_min'] for s in event_specs.values()], axis=0).tolist(),
+        'X_max'        : np.max([s['X_max'] for s in event_specs.values()], axis=0).tolist(),
+    }
+
+def get_class_weights(n_fake, n_true):
+    '''
+    [weight of fake edges, weight of true edges]
+
+    each class contributes to the weighted loss equally, both weights
+    are 1 if one of the classes has no edges
+    '''
+    n_edges = n_fake + n_true
+    if (n_fake == 0) or (n_true == 0):
+        print('Class weights can not balance %d fake and %d true edges, using 1.' \
+              %(n_fake, n_true))
+        return [1., 1.]
+    return [float(n_edges / (2*n_fake)), float(n_edges / (2*n_true))]
+
+def distribution(arr):
+    return {
+        'min' : int(arr.min()),
+        'mean': float(arr.mean()),
+        'p50' : float(np.percentile(arr, 50)),
+        'p90' : float(np.percentile(arr, 90)),
+        'max' : int(arr.max()),
+    }
+
+def get_dataset_specs(input_dir, n_workers=None, n_files=None):
+    return summarize_specs(get_event_specs(input_dir, n_workers, n_files))
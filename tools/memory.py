@@ -0,0 +1,192 @@
+import os
+import datetime
+from tools.tools import get_peak_memory, get_micro_batch
+from tools.subgraph import split_graph
+
+MEMORY_POLICIES = ['split', 'low_memory', 'skip']
+
+def get_block_widths(config):
+    '''
+    Number of floats stored per edge by EdgeNet and per node by NodeNet
+    besides the message passing matrices
+    '''
+    hid_dim = config['hid_dim']
+    if config['network'] == 'CGNN':
+        return hid_dim + 1, 2*hid_dim
+    # imported here, the validation module uses the memory model
+    from tools.validate import get_circuit
+    widths = []
+    for name, n_out in [('EN_qc', 1), ('NN_qc', hid_dim)]:
+        qc = get_circuit(config[name])
+        n_qubits = config[name]['n_qubits']
+        # input layer, circuit data, expectations and readout layer
+        widths.append(
+            2*n_qubits + int(qc.n_params) + qc.n_measurements + n_out
+        )
+    return tuple(widths)
+
+def get_simulation_memory(config):
+    '''memory of the largest state simulated at once in MB'''
+    if config['network'] == 'CGNN':
+        return 0.
+    n_states = 0
+    for name in ['EN_qc', 'NN_qc']:
+        n_qubits = config[name]['n_qubits']
+        if 'dp_noise' in config[name].keys():
+            # density matrices are simulated for noisy circuits
+            n_states = max(n_states, 4**n_qubits)
+        else:
+            n_states = max(n_states, 2**n_qubits)
+    # one complex64 state per thread
+    return 8*n_states*config['n_thread'] / 1024**2
+
+def estimate_memory(n_nodes, n_edges, config, checkpointing=False, widths=None):
+    '''
+    Estimates the peak memory of a training step on a single graph in MB
+
+    The dense Ri/Ro matrices and their stacked copy used by the message
+    passing dominate, they grow with n_nodes*n_edges. Every tensor kept
+    by the gradient tape is counted twice to account for its gradient. With
+    checkpointing only H is kept between iterations and the internals of
+    a single iteration are stored at a time.
+    '''
+    if widths is None:
+        widths = get_block_widths(config)
+    edge_width, node_width = widths
+    dim = config['hid_dim'] + 3
+    # input graph: X, Ri, Ro and the stacked R
+    graph = 3*n_nodes + 4*n_nodes*n_edges
+    # EdgeNet: bo, bi and B; NodeNet: weighted bo and bi, mi, mo, M and H
+    edge_net = n_edges*(4*dim + edge_width)
+    node_net = 2*n_edges*dim + n_nodes*(6*dim + node_width)
+    iteration = edge_net + node_net
+    if checkpointing:
+        kept = config['n_iters']*n_nodes*dim + iteration + edge_net
+    else:
+        kept = config['n_iters']*iteration + edge_net
+    return 4*(graph + 2*kept) / 1024**2 + get_simulation_memory(config)
+
+class AdmissionControl():
+    '''
+    Admits events to a training step according to the memory budget
+
+    The budget is the peak memory of the process in MB. Memory that is
+    in use when the object is created is considered as the baseline, the
+    rest is shared by the graphs of a batch, or of a micro batch if the
+    gradients are accumulated. Events that exceed it are
+    handled according to the policy:
+        split: the event is split into the smallest number of phi
+            sectors that fit together, every sector is a graph of the
+            batch
+        low_memory: the event is trained with gradient checkpointing
+        skip: the event is skipped
+    Events that can not be admitted by the policy are skipped. Every
+    decision other than admitting is logged to admission.csv.
+    '''
+    def __init__(self, config, baseline=None, n_graphs=None):
+        self.config = config
+        self.policy = config['memory_policy']
+        if self.policy not in MEMORY_POLICIES:
+            raise ValueError('Memory policy not defined!')
+        if baseline is None:
+            baseline = get_peak_memory()
+        self.baseline = baseline
+        if config['memory_budget'] <= baseline:
+            # every event would be skipped and nothing would be trained
+            raise ValueError(
+                'memory_budget of %dMB does not exceed the baseline memory of %dMB!' \
+                %(config['memory_budget'], baseline)
+            )
+        # graphs that are on the gradient tape at the same time,
+        # the evaluation holds a single graph in memory
+        if n_graphs is None:
+            n_graphs = config['batch_size']
+            if get_micro_batch(config) > 0:
+                n_graphs = min(n_graphs, get_micro_batch(config))
+        self.budget = (config['memory_budget'] - baseline) / n_graphs
+        self.widths = get_block_widths(config)
+        self.log_file = config['log_dir'] + 'admission.csv'
+
+    def estimate(self, arrays, checkpointing=False):
+        '''estimated memory of the sparse arrays of a graph in MB'''
+        n_nodes, n_edges = arrays['X'].shape[0], arrays['y'].shape[0]
+        return estimate_memory(n_nodes, n_edges, self.config,
+                               checkpointing, self.widths)
+
+    def log(self, filename, arrays, estimate, action):
+        if not os.path.isfile(self.log_file):
+            with open(self.log_file, 'a') as f:
+                f.write('filename,n_nodes,n_edges,estimated_memory,budget,action\n')
+        with open(self.log_file, 'a') as f:
+            f.write('%s,%d,%d,%f,%f,%s\n' %(
+                filename, arrays['X'].shape[0], arrays['y'].shape[0],
+                estimate, self.budget, action))
+        print(
+            str(datetime.datetime.now())
+            + ': %s: estimated %dMB exceeds %dMB, action: %s' \
+            %(os.path.basename(filename), estimate, self.budget, action)
+            )
+
+    def split(self, arrays):
+        '''
+        splits the arrays into the smallest power of 2 parts that fit,
+        the parts are trained in the same step, so together they have to
+        fit into the budget of the event
+        '''
+        n_parts = 2
+        while n_parts <= arrays['y'].shape[0]:
+            parts = split_graph(**arrays, n_parts=n_parts)
+            if sum(self.estimate(part) for part in parts) <= self.budget:
+                return parts
+            n_parts *= 2
+        return None
+
+    def __call__(self, arrays, filename='', log=True):
+        '''
+        log is False during the evaluation, which sees the same events
+        at every test
+
+        Returns:
+            parts (list): sparse arrays of the admitted graphs
+            low_memory (bool): True if the graphs need checkpointing
+        '''
+        estimate = self.estimate(arrays)
+        if estimate <= self.budget:
+            return [arrays], False
+
+        if self.policy == 'split':
+            parts = self.split(arrays)
+            if parts is not None:
+                if log: self.log(filename, arrays, estimate, 'split_%d' %len(parts))
+                return parts, False
+        elif self.policy == 'low_memory':
+            if self.estimate(arrays, checkpointing=True) <= self.budget:
+                if log: self.log(filename, arrays, estimate, 'low_memory')
+                return [arrays], True
+        if log: self.log(filename, arrays, estimate, 'skip')
+        return [], False
+
+def get_admission_control(config, n_graphs=None):
+    '''returns the AdmissionControl of the config, None if no budget is set'''
+    if 'memory_budget' not in config.keys():
+        return None
+    return AdmissionControl(config, n_graphs=n_graphs)
+
+def estimate_batch_memory(graphs, low_memory, config, widths=None):
+    '''
+    estimated memory of a training step on the graphs of a batch in MB,
+    the largest micro batch if the gradients are accumulated
+    '''
+    if widths is None:
+        widths = get_block_widths(config)
+    memory = [
+        estimate_memory(X.shape[0], y.shape[0], config, checkpointing, widths)
+        for (X, Ri, Ro, y), checkpointing in zip(graphs, low_memory)
+    ]
+    micro_batch = get_micro_batch(config)
+    if micro_batch <= 0:
+        return sum(memory)
+    return max(
+        sum(memory[start:start+micro_batch])
+        for start in range(0, len(memory), micro_batch)
+    )
@@ -0,0 +1,106 @@
+import os
+import re
+import json
+import numpy as np
+
+# One row per event and evaluation, offsets point into the scores file
+INDEX_DTYPE = np.dtype([
+    ('epoch',    np.int32),
+    ('step',     np.int32),
+    ('event_id', np.int64),
+    ('graph_id', np.int32),
+    ('offset',   np.int64),
+    ('n_edges',  np.int64),
+])
+
+def get_event_id(filename):
+    '''event and graph id from names like event000001001_g000.npz'''
+    match = re.search(r'event(\d+)(?:_g(\d+))?', os.path.basename(filename))
+    if match is None:
+        return -1, -1
+    graph_id = int(match.group(2)) if match.group(2) is not None else 0
+    return int(match.group(1)), graph_id
+
+class PredictionWriter():
+    '''
+    Appends per-edge predictions to binary files in log_dir
+
+    Files:
+        <prefix>_scores.bin: edge scores of all evaluations
+        <prefix>_labels.bin: edge labels as uint8
+        <prefix>_index.bin: rows of INDEX_DTYPE
+        <prefix>_meta.json: dtype of the scores
+    '''
+    def __init__(self, log_dir, prefix='predictions_valid', dtype='float16'):
+        self.path = log_dir + prefix
+        self.dtype = np.dtype(dtype)
+        meta_file = self.path + '_meta.json'
+        if os.path.isfile(meta_file):
+            with open(meta_file, 'r') as f:
+                meta = json.load(f)
+            if meta['dtype'] != self.dtype.name:
+                raise ValueError('Prediction store has a different dtype!')
+        else:
+            with open(meta_file, 'w') as f:
+                json.dump({'dtype': self.dtype.name}, f)
+
+    def write(self, epoch, step, filenames, preds, labels, n_edges):
+        '''
+        Writes the predictions of one evaluation with one write per file
+
+        Args:
+            filenames (list): event file of every evaluated graph
+            preds, labels (array): concatenated edge scores and labels
+            n_edges (list): number of edges of every graph
+        '''
+        scores_file = self.path + '_scores.bin'
+        if os.path.isfile(scores_file):
+            start = os.path.getsize(scores_file) // self.dtype.itemsize
+        else:
+            start = 0
+
+        index = np.zeros(len(filenames), dtype=INDEX_DTYPE)
+        index['epoch'] = epoch
+        index['step'] = step
+        ids = [get_event_id(f) for f in filenames]
+        index['event_id'] = [i[0] for i in ids]
+        index['graph_id'] = [i[1] for i in ids]
+        index['n_edges'] = n_edges
+        index['offset'] = start + np.concatenate([[0], np.cumsum(n_edges)[:-1]])
+
+        with open(scores_file, 'ab') as f:
+            np.asarray(preds, dtype=self.dtype).ravel().tofile(f)
+        with open(self.path + '_labels.bin', 'ab') as f:
+            np.asarray(labels, dtype=np.uint8).ravel().tofile(f)
+        with open(self.path + '_index.bin', 'ab') as f:
+            index.tofile(f)
+
+class PredictionReader():
+    '''Memory-mapped access to a prediction store written by PredictionWriter'''
+    def __init__(self, log_dir, prefix='predictions_valid'):
+        path = log_dir + prefix
+        with open(path + '_meta.json', 'r') as f:
+            dtype = json.load(f)['dtype']
+        self.index  = np.fromfile(path + '_index.bin', dtype=INDEX_DTYPE)
+        self.scores = np.memmap(path + '_scores.bin', dtype=dtype, mode='r')
+        self.labels = np.memmap(path + '_labels.bin', dtype=np.uint8, mode='r')
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, row):
+        '''scores and labels of a single row of the index'''
+        start = self.index['offset'][row]
+        end = start + self.index['n_edges'][row]
+        return self.scores[start:end], self.labels[start:end]
+
+    def get_evaluations(self):
+        '''(epoch, step) pairs of the stored evaluations'''
+        return sorted(set(zip(self.index['epoch'].tolist(), self.index['step'].tolist())))
+
+    def get_evaluation(self, epoch, step):
+        '''concatenated scores and labels of all events of one evaluation'''
+        rows = np.where((self.index['epoch'] == epoch) & (self.index['step'] == step))[0]
+        scores = np.concatenate([self[row][0] for row in rows])
+        labels = np.concatenate([self[row][1] for row in rows])
+        return scores, labels
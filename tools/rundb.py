@@ -0,0 +1,207 @@
+import os
+import csv
+import json
+import sqlite3
+import yaml
+import numpy as np
+
+# Files of a run directory that are ingested into the database
+# log_type of the csv files is the file name without extension
+RUN_FILES = ['config.yaml', 'summary.csv', 'log_validation.csv', 'log_training.csv']
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    path  TEXT PRIMARY KEY,
+    mtime REAL,
+    size  INTEGER
+);
+CREATE TABLE IF NOT EXISTS runs (
+    run_dir TEXT PRIMARY KEY,
+    study   TEXT,
+    config  TEXT
+);
+CREATE TABLE IF NOT EXISTS metrics (
+    run_dir  TEXT,
+    log_type TEXT,
+    row      INTEGER,
+    name     TEXT,
+    value    REAL
+);
+CREATE INDEX IF NOT EXISTS metrics_index ON metrics (run_dir, log_type, name);
+CREATE INDEX IF NOT EXISTS runs_index ON runs (study);
+'''
+
+class RunDatabase():
+    '''
+    Incremental index of log directories of the form <study>/runN/
+
+    Only files whose modification time or size changed since the last
+    update are parsed again. Rows that can not be parsed, e.g. the last
+    row of a run that is still training, are skipped and counted in
+    n_skipped, they are ingested once the file changes again. Runs whose
+    directories were deleted are removed and counted in n_removed.
+    '''
+    def __init__(self, db_path='logs/runs.sqlite'):
+        self.connection = sqlite3.connect(db_path)
+        self.connection.executescript(SCHEMA)
+        # skipped csv rows and removed runs of the last update
+        self.n_skipped = 0
+        self.n_removed = 0
+
+    def close(self):
+        self.connection.close()
+
+    def update(self, log_path_list):
+        '''indexes all run directories of the given study paths'''
+        n_updated = 0
+        self.n_skipped = 0
+        self.n_removed = 0
+        for study in log_path_list:
+            run_dirs = []
+            if os.path.isdir(study):
+                for entry in os.scandir(study):
+                    if entry.is_dir():
+                        run_dirs.append(entry.path + '/')
+                        n_updated += self.update_run(study, entry.path + '/')
+            self.remove_deleted(study, run_dirs)
+        self.connection.commit()
+        return n_updated
+
+    def remove_deleted(self, study, run_dirs):
+        '''removes the runs of a study that are not in run_dirs anymore'''
+        rows = self.connection.execute(
+            'SELECT run_dir FROM runs WHERE study=?', (study,)
+        ).fetchall()
+        for run_dir, in rows:
+            if run_dir in run_dirs:
+                continue
+            self.connection.execute('DELETE FROM runs WHERE run_dir=?', (run_dir,))
+            self.connection.execute('DELETE FROM metrics WHERE run_dir=?', (run_dir,))
+            for name in RUN_FILES:
+                self.connection.execute(
+                    'DELETE FROM files WHERE path=?', (run_dir + name,)
+                )
+            self.n_removed += 1
+
+    def update_run(self, study, run_dir):
+        n_updated = 0
+        for name in RUN_FILES:
+            path = run_dir + name
+            if not os.path.isfile(path):
+                continue
+            stat = os.stat(path)
+            row = self.connection.execute(
+                'SELECT mtime, size FROM files WHERE path=?', (path,)
+            ).fetchone()
+            if row == (stat.st_mtime, stat.st_size):
+                continue
+
+            if name == 'config.yaml':
+                self.ingest_config(study, run_dir, path)
+            else:
+                self.ingest_csv(run_dir, name[:-4], path)
+            self.connection.execute(
+                'INSERT OR REPLACE INTO files VALUES (?, ?, ?)',
+                (path, stat.st_mtime, stat.st_size)
+            )
+            n_updated += 1
+        return n_updated
+
+    def ingest_config(self, study, run_dir, path):
+        with open(path, 'r') as ymlfile:
+            config = yaml.load(ymlfile, Loader=yaml.FullLoader)
+        self.connection.execute(
+            'INSERT OR REPLACE INTO runs VALUES (?, ?, ?)',
+            (run_dir, study, json.dumps(config))
+        )
+
+    def ingest_csv(self, run_dir, log_type, path):
+        self.connection.execute(
+            'DELETE FROM metrics WHERE run_dir=? AND log_type=?',
+            (run_dir, log_type)
+        )
+        with open(path, 'r') as f:
+            reader = csv.reader(f, delimiter=',', skipinitialspace=True)
+            header = next(reader, [])
+            rows = []
+            for idx, line in enumerate(reader):
+                # rows that are being written are incomplete
+                try:
+                    if len(line) != len(header):
+                        raise ValueError()
+                    values = [float(value) for value in line]
+                except ValueError:
+                    self.n_skipped += 1
+                    continue
+                for name, value in zip(header, values):
+                    rows.append((run_dir, log_type, idx, name, value))
+        self.connection.executemany(
+            'INSERT INTO metrics VALUES (?, ?, ?, ?, ?)', rows
+        )
+
+    def get_configs(self, log_path_list):
+        '''
+        Returns the configs of the studies like tools.get_configs
+
+        The config of the first run is returned with n_runs appended.
+        '''
+        configs_dict = {}
+        for study in log_path_list:
+            rows = self.connection.execute(
+                'SELECT config FROM runs WHERE study=? ORDER BY run_dir',
+                (study,)
+            ).fetchall()
+            if len(rows) == 0:
+                continue
+            config = json.loads(rows[0][0])
+            config['n_runs'] = len(rows)
+            configs_dict[study] = config
+        return configs_dict
+
+    def get_curve(self, run_dir, metric, log_type='log_validation'):
+        '''returns the values of a metric in the order they were logged'''
+        rows = self.connection.execute(
+            'SELECT value FROM metrics WHERE run_dir=? AND log_type=? '
+            'AND name=? ORDER BY row',
+            (run_dir, log_type, metric)
+        ).fetchall()
+        # sqlite stores nan as NULL
+        return np.array([np.nan if v is None else v for v, in rows])
+
+    def get_curves(self, log_path_list, metric, log_type='log_validation',
+                   group_by=None):
+        '''
+        Returns metric curves of all runs grouped by config fields
+
+        Args:
+            metric (string): column of the csv file, e.g. 'auc'
+
+            log_type (string): csv file name without extension
+
+            group_by (list): config fields, nested fields use a dot
+                e.g. ['network', 'EN_qc.PQC_id']
+
+        Returns:
+            curves (dict): {group values: {run_dir: array}}
+        '''
+        if group_by is None:
+            group_by = []
+        curves = {}
+        for study in log_path_list:
+            rows = self.connection.execute(
+                'SELECT run_dir, config FROM runs WHERE study=? ORDER BY run_dir',
+                (study,)
+            ).fetchall()
+            for run_dir, config in rows:
+                config = json.loads(config)
+                key = tuple(get_config_field(config, field) for field in group_by)
+                curves.setdefault(key, {})[run_dir] = self.get_curve(
+                    run_dir, metric, log_type
+                )
+        return curves
+
+def get_config_field(config, field):
+    value = config
+    for item in field.split('.'):
+        value = value[item]
+    return value
@@ -0,0 +1,113 @@
+import os
+from random import shuffle
+from tools.dataset_specs import get_event_specs
+
+class BatchSampler():
+    '''
+    Forms the batches of an epoch from the event sizes
+
+    Every event is used once per epoch, except the remainder of the
+    uniform mode.
+
+    Modes:
+        uniform: shuffled events in batches of batch_size, the remainder
+            is dropped as in the original training loop
+        edge_budget: shuffled events are packed into batches whose total
+            number of edges stays below edge_budget
+        bucket: events of similar size are batched together, the events
+            are sorted into n_buckets size buckets first
+    '''
+    def __init__(self, n_edges, batch_size=1, mode='uniform',
+                 edge_budget=None, n_buckets=4):
+        self.n_edges = n_edges
+        self.batch_size = batch_size
+        self.mode = mode
+        self.edge_budget = edge_budget
+        self.n_buckets = n_buckets
+        if (mode == 'edge_budget') and (edge_budget is None):
+            raise ValueError('edge_budget sampler requires an edge_budget!')
+        if mode not in ['uniform', 'edge_budget', 'bucket']:
+            raise ValueError('Batch sampler not defined!')
+
+    def get_batches(self):
+        '''returns the batches of a new epoch as lists of event indices'''
+        if self.mode == 'uniform':
+            batches = self.uniform_batches()
+        elif self.mode == 'edge_budget':
+            batches = self.edge_budget_batches()
+        elif self.mode == 'bucket':
+            batches = self.bucket_batches()
+        # shuffle the order of the batches every epoch
+        if self.mode != 'uniform':
+            shuffle(batches)
+        return batches
+
+    def uniform_batches(self):
+        event_list = [i for i in range(len(self.n_edges))]
+        shuffle(event_list)
+        n_batches = len(event_list)//self.batch_size
+        return [
+            event_list[n*self.batch_size:(n+1)*self.batch_size]
+            for n in range(n_batches)
+        ]
+
+    def edge_budget_batches(self):
+        event_list = [i for i in range(len(self.n_edges))]
+        shuffle(event_list)
+        # first fit packing of the shuffled events
+        batches, batch_edges = [], []
+        for idx in event_list:
+            for n, n_edges in enumerate(batch_edges):
+                if n_edges + self.n_edges[idx] <= self.edge_budget:
+                    batches[n].append(idx)
+                    batch_edges[n] += self.n_edges[idx]
+                    break
+            else:
+                # events larger than the budget form a batch on their own
+                batches.append([idx])
+                batch_edges.append(self.n_edges[idx])
+        return batches
+
+    def bucket_batches(self):
+        # sort events by size, shuffle within buckets of similar size
+        event_list = sorted(range(len(self.n_edges)), key=lambda i: self.n_edges[i])
+        bucket_size = -(-len(event_list)//self.n_buckets)
+        batches, remainder = [], []
+        for n in range(self.n_buckets):
+            bucket = event_list[n*bucket_size:(n+1)*bucket_size]
+            shuffle(bucket)
+            n_full = len(bucket)//self.batch_size
+            for k in range(n_full):
+                batches.append(bucket[k*self.batch_size:(k+1)*self.batch_size])
+            remainder += bucket[n_full*self.batch_size:]
+        # leftover events of the buckets are batched together
+        for k in range(0, len(remainder), self.batch_size):
+            batches.append(remainder[k:k+self.batch_size])
+        return batches
+
+def get_sampler(config, filenames):
+    '''returns the BatchSampler specified in the config for the given events'''
+    if 'batch_sampler' in config.keys():
+        mode = config['batch_sampler']
+    else:
+        mode = 'uniform'
+    if 'edge_budget' in config.keys():
+        edge_budget = config['edge_budget']
+    else:
+        edge_budget = None
+    if 'n_buckets' in config.keys():
+        n_buckets = config['n_buckets']
+    else:
+        n_buckets = 4
+
+    # event sizes are read once from the dataset index
+    if mode == 'uniform':
+        n_edges = [0 for _ in filenames]
+    else:
+        specs = get_event_specs(config['train_dir'], config['n_thread'])
+        n_edges = [specs[os.path.basename(f)]['n_edges'] for f in filenames]
+
+    return BatchSampler(
+        n_edges, config['batch_size'], mode,
+        edge_budget=edge_budget, n_buckets=n_buckets
+    )
@@ -0,0 +1,124 @@
+import numpy as np
+from tools.tools import load_sparse, sparse_to_graph
+
+SUBGRAPH_MODES = ['none', 'phi_window', 'z_window', 'edges']
+
+def select_edges(X, in_node, out_node, mode, n_sample, rng):
+    '''
+    Returns the sorted ids of the edges of a subgraph
+
+    Modes:
+        phi_window: n_sample consecutive edges in phi of their outer node,
+            the window wraps around at phi=+-pi
+        z_window: n_sample consecutive edges in z of their outer node
+        edges: n_sample uniformly sampled edges
+    '''
+    n_edges = in_node.shape[0]
+    if mode == 'phi_window':
+        order = np.argsort(X[out_node, 1], kind='stable')
+        start = rng.randint(n_edges)
+        selected = order[(start + np.arange(n_sample)) % n_edges]
+    elif mode == 'z_window':
+        order = np.argsort(X[out_node, 2], kind='stable')
+        start = rng.randint(n_edges - n_sample + 1)
+        selected = order[start:start+n_sample]
+    elif mode == 'edges':
+        selected = rng.choice(n_edges, n_sample, replace=False)
+    else:
+        raise ValueError('Subgraph sampling mode not defined!')
+    return np.sort(selected)
+
+def sample_subgraph(X, Ri_rows, Ri_cols, Ro_rows, Ro_cols, y, mode, n_sample,
+                    rng=np.random):
+    '''
+    Samples a subgraph with at most n_sample edges from sparse arrays
+
+    Returns the sparse arrays of the subgraph with re-indexed nodes and
+    edges. Every edge is expected to have exactly one input and one
+    output node.
+    '''
+    n_edges = y.shape[0]
+    if n_edges <= n_sample:
+        return dict(X=X, Ri_rows=Ri_rows, Ri_cols=Ri_cols,
+                    Ro_rows=Ro_rows, Ro_cols=Ro_cols, y=y)
+
+    in_node, out_node = get_edge_nodes(Ri_rows, Ri_cols, Ro_rows, Ro_cols)
+    selected = select_edges(X, in_node, out_node, mode, n_sample, rng)
+    return edge_subgraph(X, in_node, out_node, y, selected)
+
+def split_graph(X, Ri_rows, Ri_cols, Ro_rows, Ro_cols, y, n_parts):
+    '''
+    Splits a graph into n_parts subgraphs of consecutive edges in phi
+
+    Every edge belongs to exactly one part, nodes on the borders of the
+    phi sectors appear in multiple parts.
+    '''
+    in_node, out_node = get_edge_nodes(Ri_rows, Ri_cols, Ro_rows, Ro_cols)
+    return [
+        edge_subgraph(X, in_node, out_node, y, selected)
+        for selected in split_edges(X, Ri_rows, Ri_cols, Ro_rows, Ro_cols, y, n_parts)
+    ]
+
+def split_edges(X, Ri_rows, Ri_cols, Ro_rows, Ro_cols, y, n_parts):
+    '''edge ids of the parts of split_graph in the order of the parts'''
+    in_node, out_node = get_edge_nodes(Ri_rows, Ri_cols, Ro_rows, Ro_cols)
+    order = np.argsort(X[out_node, 1], kind='stable')
+    return [np.sort(selected) for selected in np.array_split(order, n_parts)]
+
+def get_edge_nodes(Ri_rows, Ri_cols, Ro_rows, Ro_cols):
+    '''returns the input and output node of every edge'''
+    n_edges = Ri_rows.shape[0]
+    in_node = np.zeros(n_edges, dtype=np.int64)
+    out_node = np.zeros(n_edges, dtype=np.int64)
+    in_node[Ri_cols] = Ri_rows
+    out_node[Ro_cols] = Ro_rows
+    return in_node, out_node
+
+def edge_subgraph(X, in_node, out_node, y, selected):
+    '''returns the sparse arrays of the subgraph of the selected edges'''
+    # keep only the nodes of the selected edges
+    nodes = np.unique(np.concatenate([in_node[selected], out_node[selected]]))
+    edges = np.arange(selected.shape[0])
+    return dict(
+        X=X[nodes],
+        Ri_rows=np.searchsorted(nodes, in_node[selected]), Ri_cols=edges,
+        Ro_rows=np.searchsorted(nodes, out_node[selected]), Ro_cols=edges,
+        y=y[selected],
+    )
+
+class SubgraphSampler():
+    '''
+    Loads events as subgraphs with a bounded number of edges
+
+    The loss is a mean over the sampled edges, which already estimates
+    the per-edge loss of the event. The returned scale n_edges/n_sampled
+    is only used to weight the events of a batch by their full size,
+    load_batch normalizes it within the batch.
+    '''
+    def __init__(self, mode, n_sample, seed=None):
+        if mode not in SUBGRAPH_MODES:
+            raise ValueError('Subgraph sampling mode not defined!')
+        self.mode = mode
+        self.n_sample = n_sample
+        self.rng = np.random.RandomState(seed)
+
+    def sample(self, arrays):
+        '''returns the sparse arrays of a subgraph and its weight scale'''
+        n_edges = arrays['y'].shape[0]
+        if self.mode == 'none':
+            return arrays, 1.
+        arrays = sample_subgraph(**arrays, mode=self.mode,
+                                 n_sample=self.n_sample, rng=self.rng)
+        return arrays, n_edges / arrays['y'].shape[0]
+
+    def __call__(self, filename):
+        '''returns the subgraph of an event and its weight scale'''
+        arrays, scale = self.sample(load_sparse(filename))
+        return sparse_to_graph(**arrays), scale
+
+def get_subgraph_sampler(config):
+    '''returns the SubgraphSampler of the config, None if not requested'''
+    if ('subgraph_sampling' not in config.keys()) or \
+            (config['subgraph_sampling'] == 'none'):
+        return None
+    return SubgraphSampler(config['subgraph_sampling'], config['subgraph_edges'])
@@ -0,0 +1,196 @@
+import os
+import datetime
+import threading
+from collections import deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+from tools.tools import get_resident_memory
+
+# columns of log_validation.csv exposed as the last validation metrics
+VALIDATION_COLUMNS = {
+    'accuracy' : 0,
+    'auc'      : 1,
+    'loss'     : 2,
+    'precision': 9,
+    'recall'   : 10,
+    'f1'       : 11,
+}
+# number of columns of a complete row of log_validation.csv
+N_VALIDATION_COLUMNS = 19
+STEP_QUANTILES = [0.5, 0.9, 0.99]
+
+class Telemetry():
+    '''
+    Serves the state of a training run in the Prometheus text format
+
+    The training loop only stores its state under a lock, the metrics
+    are formatted by the HTTP server thread when they are scraped, so
+    that a slow or stalled client never blocks a training step. Step
+    time quantiles and the rates are computed over the last window
+    steps. The last validation metrics are read from
+    log_validation.csv, which is also written by the AsyncTester.
+    '''
+    def __init__(self, config, port, host='127.0.0.1', window=100):
+        self.config = config
+        self.lock = threading.Lock()
+        self.steps = deque(maxlen=window)
+        self.state = {
+            'epoch'          : 0,
+            'step'           : 0,
+            'steps_total'    : 0,
+            'graphs_total'   : 0,
+            'edges_total'    : 0,
+            'batches_pending': 0,
+            'tests_pending'  : 0,
+            'loss'           : np.nan,
+            'peak_memory'    : np.nan,
+            'last_step_time' : np.nan,
+        }
+        # last complete row of log_validation.csv
+        self.validation = None
+        telemetry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ['/', '/metrics']:
+                    self.send_error(404)
+                    return
+                body = telemetry.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # scrapes are not printed to the training output
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        # the address is stored in the log directory, port 0 picks a free port
+        self.url = 'http://%s:%d/metrics' %self.server.server_address[:2]
+        with open(config['log_dir'] + 'telemetry_url.txt', 'w') as f:
+            f.write(self.url + '\n')
+        print(str(datetime.datetime.now()) + ': Telemetry is served at ' + self.url)
+
+    def update_step(self, epoch, step, duration, graphs, loss=np.nan,
+                    peak_memory=np.nan, batches_pending=0, tests_pending=0):
+        '''records a training step, called from the training loop'''
+        n_edges = sum(graph[-1].shape[0] for graph in graphs)
+        with self.lock:
+            self.steps.append((duration, len(graphs), n_edges))
+            self.state.update({
+                'epoch'          : epoch,
+                'step'           : step,
+                'steps_total'    : self.state['steps_total'] + 1,
+                'graphs_total'   : self.state['graphs_total'] + len(graphs),
+                'edges_total'    : self.state['edges_total'] + n_edges,
+                'batches_pending': batches_pending,
+                'tests_pending'  : tests_pending,
+                'loss'           : loss,
+                'peak_memory'    : peak_memory,
+                'last_step_time' : datetime.datetime.now().timestamp(),
+            })
+
+    def read_validation(self):
+        '''
+        last complete row of log_validation.csv, None if there is none yet
+
+        A row that is still being written is not complete and is skipped,
+        the last complete row is cached in case the file can not be read.
+        '''
+        log_file = self.config['log_dir'] + 'log_validation.csv'
+        if not os.path.isfile(log_file):
+            return self.validation
+        with open(log_file, 'r') as f:
+            for line in f:
+                try:
+                    row = [float(value) for value in line.split(',')]
+                except ValueError:
+                    continue
+                if len(row) == N_VALIDATION_COLUMNS:
+                    self.validation = row
+        return self.validation
+
+    def render(self):
+        '''metrics in the Prometheus text format'''
+        with self.lock:
+            state = dict(self.state)
+            steps = np.array(self.steps).reshape(-1, 3)
+
+        lines = []
+        def add(name, kind, help, samples):
+            lines.append('# HELP qtrkx_%s %s' %(name, help))
+            lines.append('# TYPE qtrkx_%s %s' %(name, kind))
+            for labels, value in samples:
+                value = float(value)
+                lines.append('qtrkx_%s%s %s' %(name, labels, 'NaN' if np.isnan(value) else repr(value)))
+
+        add('epoch', 'gauge', 'Current epoch.', [('', state['epoch'])])
+        add('step', 'gauge', 'Current step of the epoch.', [('', state['step'])])
+        add('steps_total', 'counter', 'Training steps since the start.',
+            [('', state['steps_total'])])
+        add('graphs_total', 'counter', 'Graphs trained on since the start.',
+            [('', state['graphs_total'])])
+        add('edges_total', 'counter', 'Edges trained on since the start.',
+            [('', state['edges_total'])])
+        add('last_step_timestamp_seconds', 'gauge',
+            'Unix time of the last training step.', [('', state['last_step_time'])])
+
+        if len(steps) > 0:
+            quantiles = np.quantile(steps[:,0], STEP_QUANTILES)
+            duration = steps[:,0].sum()
+        else:
+            quantiles = [np.nan]*len(STEP_QUANTILES)
+            duration = 0.
+        add('step_seconds', 'summary',
+            'Duration of the last training steps.',
+            [('{quantile="%s"}' %q, v) for q, v in zip(STEP_QUANTILES, quantiles)]
+            + [('_sum', duration), ('_count', len(steps))])
+        add('graphs_per_second', 'gauge', 'Graphs per second over the last steps.',
+            [('', steps[:,1].sum()/duration if duration > 0 else np.nan)])
+        add('edges_per_second', 'gauge', 'Edges per second over the last steps.',
+            [('', steps[:,2].sum()/duration if duration > 0 else np.nan)])
+
+        add('batches_pending', 'gauge', 'Batches left in the current epoch.',
+            [('', state['batches_pending'])])
+        add('tests_pending', 'gauge',
+            'Weight snapshots waiting for the asynchronous evaluation.',
+            [('', state['tests_pending'])])
+        add('loss', 'gauge', 'Loss of the last training step.', [('', state['loss'])])
+        add('resident_memory_megabytes', 'gauge', 'Resident memory of the trainer.',
+            [('', get_resident_memory())])
+        add('step_peak_memory_megabytes', 'gauge',
+            'Peak memory of the last training step.', [('', state['peak_memory'])])
+
+        row = self.read_validation()
+        if row is not None:
+            for name, col in VALIDATION_COLUMNS.items():
+                add('validation_' + name, 'gauge', 'Last validation %s.' %name,
+                    [('', row[col])])
+            add('validation_epoch', 'gauge', 'Epoch of the last validation.',
+                [('', row[-2])])
+            add('validation_step', 'gauge', 'Step of the last validation.',
+                [('', row[-1])])
+        return '\n'.join(lines) + '\n'
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+def get_telemetry(config):
+    '''returns the Telemetry of the config, None if no port is set'''
+    if ('telemetry_port' not in config.keys()) or (config['telemetry_port'] is None):
+        return None
+    try:
+        return Telemetry(config, config['telemetry_port'])
+    except OSError as error:
+        # training continues without telemetry, e.g. if the port is taken
+        print(
+            str(datetime.datetime.now())
+            + ': Telemetry could not be started: ' + str(error)
+            )
+        return None
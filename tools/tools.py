@@ -1,11 +1,10 @@
 import tools
 import numpy as np
-import matplotlib.pyplot as plt
 from collections import namedtuple
 #internal
-import os, sys, glob, yaml, datetime, argparse
+import os, sys, glob, yaml, datetime, argparse, resource, zipfile
 import csv
-import tensorflow as tf
+from tools.compact import is_compact, compact_to_sparse
 
 Graph = namedtuple('Graph', ['X', 'Ri', 'Ro', 'y'])
 
@@ -25,10 +24,44 @@ class GraphDataset():
 
 def get_dataset(input_dir,n_files):
     return GraphDataset(input_dir, n_files)
+
+def build_model(config):
+    '''returns the GNN model specified in the config'''
+    if config['network'] == 'QGNN':
+        from qnetworks.QGNN import GNN
+    elif config['network'] == 'CGNN':
+        from qnetworks.CGNN import GNN
+    else:
+        raise ValueError('Wrong network specification!')
+    GNN.config = config
+    return GNN()
 def load_graph(filename):
     """Reade a single graph NPZ"""
+    return sparse_to_graph(**load_sparse(filename))
+def load_sparse(filename):
+    """Reade the sparse arrays of a single graph NPZ"""
     with np.load(filename) as f:
-        return sparse_to_graph(**dict(f.items()))
+        arrays = dict(f.items())
+    # decode events stored in the compact format
+    if is_compact(arrays):
+        arrays = compact_to_sparse(**arrays)
+    return arrays
+def get_graph_size(filename):
+    '''number of nodes and edges of an event read from the npy headers only'''
+    with zipfile.ZipFile(filename) as archive:
+        names = archive.namelist()
+        # compact events store the coordinates under a different name
+        node_key = [k for k in ['X.npy', 'X_q.npy', 'X_f16.npy'] if k in names][0]
+        shapes = []
+        for key in [node_key, 'Ri_rows.npy']:
+            with archive.open(key) as f:
+                version = np.lib.format.read_magic(f)
+                if version == (1, 0):
+                    shape, _, _ = np.lib.format.read_array_header_1_0(f)
+                else:
+                    shape, _, _ = np.lib.format.read_array_header_2_0(f)
+            shapes.append(shape[0])
+    return shapes[0], shapes[1]
 def sparse_to_graph(X, Ri_rows, Ri_cols, Ro_rows, Ro_cols, y, dtype=np.float32):
     n_nodes, n_edges = X.shape[0], Ri_rows.shape[0]
     Ri = np.zeros((n_nodes, n_edges), dtype=dtype)
@@ -43,26 +76,33 @@ def parse_args():
     add_arg = parser.add_argument
     add_arg('config')
     add_arg('RID')
+    add_arg('--dry-run', action='store_true',
+            help='validate the config and estimate the cost without training')
     return parser.parse_args()
+def read_config(path):
+    # read the config file without touching the log directory
+    with open(path, 'r') as ymlfile:
+        return yaml.load(ymlfile, Loader=yaml.FullLoader)
 def load_config(args):
     # read the config file 
-    with open(args.config, 'r') as ymlfile:
-        config = yaml.load(ymlfile, Loader=yaml.FullLoader)
-        if len(glob.glob(config['log_dir']))==0:
-            os.mkdir(config['log_dir'])
-        # append RID to log dir
-        config['log_dir'] = config['log_dir']+'run{}/'.format(args.RID)
-        if len(glob.glob(config['log_dir']))==0:
-            os.mkdir(config['log_dir'])
-        # print all configs
-        print('Printing configs: ')
-        for key in config:
-            print(key + ': ' + str(config[key]))
-        print('Log dir: ' + config['log_dir'])
-        print('Training data input dir: ' + config['train_dir'])
-        print('Validation data input dir: ' + config['train_dir'])
-        if config['run_type'] == 'new_run':
-            delete_all_logs(config['log_dir'])
+    return setup_log_dir(read_config(args.config), args.RID)
+def setup_log_dir(config, RID):
+    # create the log dir of the run and log the config
+    if len(glob.glob(config['log_dir']))==0:
+        os.mkdir(config['log_dir'])
+    # append RID to log dir
+    config['log_dir'] = config['log_dir']+'run{}/'.format(RID)
+    if len(glob.glob(config['log_dir']))==0:
+        os.mkdir(config['log_dir'])
+    # print all configs
+    print('Printing configs: ')
+    for key in config:
+        print(key + ': ' + str(config[key]))
+    print('Log dir: ' + config['log_dir'])
+    print('Training data input dir: ' + config['train_dir'])
+    print('Validation data input dir: ' + config['train_dir'])
+    if config['run_type'] == 'new_run':
+        delete_all_logs(config['log_dir'])
     # LOG the config every time
     with open(config['log_dir'] + 'config.yaml', 'w') as f:
         for key in config:
@@ -71,21 +111,52 @@ def load_config(args):
     return config
 
 def delete_all_logs(log_dir):
-# Delete all .csv files in directory
+# Delete all .csv files and the prediction store in directory
     log_list = os.listdir(log_dir)
     for item in log_list:
-        if item.endswith('.csv'):
+        if item.endswith('.csv') or item.startswith('predictions_'):
             os.remove(log_dir+item)
             print(str(datetime.datetime.now()) + ' Deleted old log: ' + log_dir+item)
     init_all_logs(log_dir)
 
 def init_all_logs(log_dir):
     with open(log_dir+'log_validation.csv', 'a') as f: 
-        f.write('accuracy,auc,loss,precision,accuracy_3,precision_3,recall_3,f1_3,accuracy_5,precision_5,recall_5,f1_5,accuracy_7,precision_7,recall_7,f1_7,duration\n')
+        f.write('accuracy,auc,loss,precision,accuracy_3,precision_3,recall_3,f1_3,accuracy_5,precision_5,recall_5,f1_5,accuracy_7,precision_7,recall_7,f1_7,duration,epoch,step\n')
     with open(log_dir+'log_training.csv', 'a') as f: 
-        f.write('accuracy,auc,loss,precision,accuracy_3,precision_3,recall_3,f1_3,accuracy_5,precision_5,recall_5,f1_5,accuracy_7,precision_7,recall_7,f1_7,duration\n')
+        f.write('accuracy,auc,loss,precision,accuracy_3,precision_3,recall_3,f1_3,accuracy_5,precision_5,recall_5,f1_5,accuracy_7,precision_7,recall_7,f1_7,duration,epoch,step\n')
     with open(log_dir+'summary.csv', 'a') as f:
-        f.write('epoch,batch,loss,duration\n')
+        f.write('epoch,batch,loss,duration,peak_memory,estimated_memory\n')
+
+def get_peak_memory():
+    '''peak resident memory of the process since the last reset in MB'''
+    if os.path.isfile('/proc/self/status'):
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    # given in kilobytes
+                    return int(line.split()[1]) / 1024
+    # ru_maxrss is given in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def get_resident_memory():
+    '''current resident memory of the process in MB'''
+    if os.path.isfile('/proc/self/status'):
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    # given in kilobytes
+                    return int(line.split()[1]) / 1024
+    # only the peak is available on other systems
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def reset_peak_memory():
+    '''resets the peak resident memory to the current one, Linux only'''
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        # the peak of the whole run is reported instead
+        pass
 
 
 def log_parameters(log_dir, parameters):
@@ -178,14 +249,23 @@ def find_layer(arr):
             raise ValueError()
     return layers
 
+def get_micro_batch(config):
+    '''number of graphs per gradient tape, 0 uses one tape for the batch'''
+    if 'micro_batch' in config.keys():
+        return config['micro_batch']
+    return 0
+
 def true_fake_weights(labels):
     ''' 
     [weight of fake edges, weight of true edges]
     
     weights are calculated using scripts/print_dataset_specs.py
+    config['class_weights'] overrides the weights of the dataset
 
     '''
-    if tools.config['dataset'] == 'mu200':
+    if 'class_weights' in tools.config.keys():
+        weight_list = tools.config['class_weights']
+    elif tools.config['dataset'] == 'mu200':
         weight_list = [1.102973565242351, 0.9146118742361756]
     elif tools.config['dataset'] == 'mu200_1pT':
         weight_list = [1.024985997012696, 0.9762031776515252]
@@ -198,7 +278,9 @@ def true_fake_weights(labels):
     else:
         raise ValueError('dataset not defined')
 
-    return [weight_list[int(labels[i])] for i in range(labels.shape[0])]
+    # look up the weight of every edge at once
+    weight_list = np.array(weight_list, dtype=np.float32)
+    return weight_list[np.asarray(labels).astype(int)]
 
 def load_params(model, log_path):
     n_layers = len(glob.glob('{}*{}*'.format(log_path,'parameters')))
@@ -0,0 +1,113 @@
+import tensorflow as tf
+from tools.tools import Graph, map2angle, true_fake_weights, load_sparse, sparse_to_graph
+
+def load_batch(data, batch_list, subgraph_sampler=None, admission=None):
+    '''
+    loads the graphs of a batch and maps their coordinates to [0,1]
+
+    Returns:
+        graphs (list): graphs of the batch
+        scales (list): weight scale of every graph, normalized within the
+            batch, all scales are 1 if no subgraphs are sampled
+        low_memory (list): True for graphs that need checkpointing
+    '''
+    graphs, scales, low_memory = [], [], []
+    for idx in batch_list:
+        filename = data.filenames[idx]
+        arrays, scale = load_sparse(filename), 1.
+        if subgraph_sampler is not None:
+            arrays, scale = subgraph_sampler.sample(arrays)
+        # split, route or skip events exceeding the memory budget
+        if admission is not None:
+            parts, checkpointing = admission(arrays, filename)
+        else:
+            parts, checkpointing = [arrays], False
+        for part in parts:
+            X, Ri, Ro, y = sparse_to_graph(**part)
+            graphs.append(Graph(map2angle(X), Ri, Ro, y))
+            scales.append(scale)
+            low_memory.append(checkpointing)
+    # The mean loss over the sampled edges is unbiased, subgraphs are
+    # only weighted by the size of their event relative to the batch:
+    # scale_i = (n_edges_i/n_sampled_i) * sum(n_sampled)/sum(n_edges)
+    n_sampled = sum(graph.y.shape[0] for graph in graphs)
+    n_edges = sum(scale*graph.y.shape[0] for graph, scale in zip(graphs, scales))
+    if n_sampled > 0:
+        scales = [scale * n_sampled / n_edges for scale in scales]
+    return graphs, scales, low_memory
+
+def run_model(model, graph_array, low_memory=False):
+    '''executes the model, with checkpointing if low_memory is set'''
+    if not low_memory:
+        return model(graph_array)
+    checkpointing = model.checkpointing
+    model.checkpointing = True
+    try:
+        return model(graph_array)
+    finally:
+        model.checkpointing = checkpointing
+
+def batch_loss(model, loss_fn, graphs, scales, low_memory):
+    '''combines multiple  graph inputs and returns the loss of their mean'''
+    for batch, (X, Ri, Ro, y) in enumerate(graphs):
+
+        label = tf.reshape(tf.convert_to_tensor(y),shape=(y.shape[0],1))
+        
+        if batch==0:
+            # calculate weight for each edge to avoid class imbalance
+            weights = tf.convert_to_tensor(true_fake_weights(y)*scales[batch])
+            # reshape weights
+            weights = tf.reshape(tf.convert_to_tensor(weights),
+                                 shape=(weights.shape[0],1))
+            preds = run_model(model, [X,Ri,Ro], low_memory[batch])
+            labels = label
+        else:
+            weight = tf.convert_to_tensor(true_fake_weights(y)*scales[batch])
+            # reshape weights
+            weight = tf.reshape(tf.convert_to_tensor(weight),
+                                shape=(weight.shape[0],1))
+
+            weights = tf.concat([weights, weight],axis=0)
+            preds = tf.concat([preds, run_model(model, [X,Ri,Ro], low_memory[batch])],axis=0)
+            labels = tf.concat([labels, label],axis=0)
+
+    return loss_fn(labels, preds, sample_weight=weights)
+
+def batch_train_step(model, opt, loss_fn, graphs, scales=None, low_memory=None,
+                     micro_batch=0):
+    '''
+    executes a step on the mean loss of multiple graphs
+
+    With micro_batch > 0 the loss and the gradients are computed for
+    micro_batch graphs at a time and accumulated, so that only their
+    tape is kept in memory. The loss of every micro batch is the mean
+    over its edges, scaling it by its share of the edges of the batch
+    gives the same loss and gradients as a single tape.
+    '''
+    if scales is None:
+        scales = [1. for _ in graphs]
+    if low_memory is None:
+        low_memory = [False for _ in graphs]
+    if micro_batch <= 0:
+        micro_batch = len(graphs)
+    n_edges = sum(y.shape[0] for _, _, _, y in graphs)
+
+    loss_eval, grads = 0., None
+    for start in range(0, len(graphs), micro_batch):
+        end = start + micro_batch
+        share = sum(y.shape[0] for _, _, _, y in graphs[start:end]) / n_edges
+        with tf.GradientTape() as tape:
+            loss = share * batch_loss(
+                model, loss_fn, graphs[start:end], scales[start:end],
+                low_memory[start:end]
+            )
+        micro_grads = tape.gradient(loss, model.trainable_variables)
+        if grads is None:
+            grads = micro_grads
+        else:
+            grads = [g + micro_g for g, micro_g in zip(grads, micro_grads)]
+        loss_eval += loss
+
+    opt.apply_gradients(zip(grads, model.trainable_variables))
+
+    return loss_eval, grads
@@ -0,0 +1,218 @@
+import os
+import ast
+import json
+import numpy as np
+from qcircuits.QCircuit import QCircuit
+from tools.tools import get_graph_size, get_micro_batch
+from tools.subgraph import SUBGRAPH_MODES
+from tools.memory import MEMORY_POLICIES, estimate_memory
+
+# Only light modules are imported here, configs are validated before
+# TensorFlow and the quantum stack are loaded
+
+REQUIRED_KEYS = [
+    'train_dir', 'valid_dir', 'dataset', 'log_dir', 'run_type', 'gpu',
+    'n_valid', 'n_train', 'lr_c', 'batch_size', 'n_iters', 'n_epoch',
+    'TEST_every', 'hid_dim', 'network', 'optimizer', 'loss_func',
+    'n_thread', 'log_verbosity',
+]
+REQUIRED_QC_KEYS = ['PQC_id', 'IEC_id', 'MC_id', 'n_layers', 'repetitions', 'n_qubits']
+NETWORKS = ['QGNN', 'CGNN']
+# simulation backends of qnetworks/backends.py
+BACKENDS = ['auto', 'qsim', 'cirq', 'density_matrix', 'trajectories']
+# default differentiator of TFQ or qnetworks/parameter_shift.py
+DIFFERENTIATORS = ['default', 'batched_shift']
+DATASETS = ['mu200', 'mu200_full', 'mu200_1pT', 'mu10', 'mu10_big']
+RUN_TYPES = ['new_run', 'continue']
+MEASUREMENTS = ['measure_all', 'measure_last']
+
+def get_circuit_functions(path='qcircuits/circuits.py'):
+    '''names of the functions defined in the circuit library'''
+    with open(path, 'r') as f:
+        tree = ast.parse(f.read())
+    return [node.name for node in tree.body if isinstance(node, ast.FunctionDef)]
+
+def get_event_files(input_dir):
+    input_dir = os.path.expandvars(input_dir)
+    return [os.path.join(input_dir, f) for f in os.listdir(input_dir)
+            if f.startswith('event') and f.endswith('.npz')]
+
+def validate_circuit(qc_config, name):
+    errors = []
+    for key in REQUIRED_QC_KEYS:
+        if key not in qc_config.keys():
+            errors.append('%s: missing key %s' %(name, key))
+    if errors:
+        return errors
+
+    with open('qcircuits/circuits_metadata.json') as json_file:
+        metadata = json.load(json_file)
+    functions = get_circuit_functions()
+
+    if qc_config['IEC_id'] not in metadata['qc_iec_dict'].keys():
+        errors.append('%s: unknown IEC_id %s' %(name, qc_config['IEC_id']))
+    elif metadata['qc_iec_dict'][qc_config['IEC_id']] not in functions:
+        errors.append('%s: IEC_id %s is not implemented' %(name, qc_config['IEC_id']))
+    if qc_config['PQC_id'] not in metadata['qc_pqc_dict'].keys():
+        errors.append('%s: unknown PQC_id %s' %(name, qc_config['PQC_id']))
+    elif metadata['qc_pqc_dict'][qc_config['PQC_id']] not in functions:
+        errors.append('%s: PQC_id %s is not implemented' %(name, qc_config['PQC_id']))
+    if qc_config['MC_id'] not in MEASUREMENTS:
+        errors.append('%s: unknown MC_id %s' %(name, qc_config['MC_id']))
+    if ('backend' in qc_config.keys()) and (qc_config['backend'] not in BACKENDS):
+        errors.append('%s: unknown backend %s' %(name, qc_config['backend']))
+    if ('differentiator' in qc_config.keys()) and \
+            (qc_config['differentiator'] not in DIFFERENTIATORS):
+        errors.append('%s: unknown differentiator %s' %(name, qc_config['differentiator']))
+    if ('shard_size' in qc_config.keys()) and (qc_config['shard_size'] < 0):
+        errors.append('%s: shard_size has to be positive or 0' %name)
+    if errors:
+        return errors
+
+    try:
+        get_circuit(qc_config)
+    except ValueError as error:
+        errors.append('%s: %s' %(name, error))
+    return errors
+
+def get_circuit(qc_config):
+    '''QCircuit of the config, only dimensions are available without cirq'''
+    return QCircuit(
+        IEC_id=qc_config['IEC_id'],
+        PQC_id=qc_config['PQC_id'],
+        MC_id=qc_config['MC_id'],
+        n_layers=qc_config['n_layers'],
+        input_size=qc_config['n_qubits'],
+        p=0.01
+    )
+
+def validate_config(config):
+    '''
+    Checks the config without loading TensorFlow
+
+    Returns:
+        errors (list): description of every problem found, empty if valid
+    '''
+    errors = []
+    for key in REQUIRED_KEYS:
+        if key not in config.keys():
+            errors.append('missing key %s' %key)
+    if errors:
+        return errors
+
+    if config['network'] not in NETWORKS:
+        errors.append('unknown network %s' %config['network'])
+    if config['dataset'] not in DATASETS:
+        errors.append('unknown dataset %s' %config['dataset'])
+    if config['run_type'] not in RUN_TYPES:
+        errors.append('unknown run_type %s' %config['run_type'])
+    if 'class_weights' in config.keys():
+        weights = config['class_weights']
+        if (weights != 'auto') and not (isinstance(weights, list) and len(weights) == 2):
+            errors.append("class_weights must be 'auto' or [fake, true]")
+    if 'batch_sampler' in config.keys():
+        if config['batch_sampler'] not in ['uniform', 'edge_budget', 'bucket']:
+            errors.append('unknown batch_sampler %s' %config['batch_sampler'])
+        elif (config['batch_sampler'] == 'edge_budget') and ('edge_budget' not in config.keys()):
+            errors.append('edge_budget sampler requires edge_budget')
+    if 'subgraph_sampling' in config.keys():
+        if config['subgraph_sampling'] not in SUBGRAPH_MODES:
+            errors.append('unknown subgraph_sampling %s' %config['subgraph_sampling'])
+        elif (config['subgraph_sampling'] != 'none') and ('subgraph_edges' not in config.keys()):
+            errors.append('subgraph_sampling requires subgraph_edges')
+    if get_micro_batch(config) < 0:
+        errors.append('micro_batch has to be positive or 0')
+    if ('early_exit_tol' in config.keys()) and (config['early_exit_tol'] < 0):
+        errors.append('early_exit_tol has to be positive or 0')
+    if ('prune_threshold' in config.keys()) and \
+            not (0 <= config['prune_threshold'] < 1):
+        errors.append('prune_threshold has to be in [0, 1)')
+    if 'memory_budget' in config.keys():
+        if 'memory_policy' not in config.keys():
+            errors.append('memory_budget requires memory_policy')
+        elif config['memory_policy'] not in MEMORY_POLICIES:
+            errors.append('unknown memory_policy %s' %config['memory_policy'])
+    if ('async_test' in config.keys()) and config['async_test'] and \
+            ('n_test_workers' in config.keys()) and (config['n_test_workers'] > 1):
+        # the daemon process of the AsyncTester can not start a TestPool
+        errors.append('n_test_workers > 1 can not be combined with async_test')
+    if ('telemetry_port' in config.keys()) and (config['telemetry_port'] is not None) \
+            and not (0 <= config['telemetry_port'] <= 65535):
+        errors.append('telemetry_port has to be in [0, 65535]')
+    if config['batch_size'] > config['n_train']:
+        errors.append('batch_size is larger than n_train')
+
+    for key, n_key in [('train_dir', 'n_train'), ('valid_dir', 'n_valid')]:
+        if not os.path.isdir(os.path.expandvars(config[key])):
+            errors.append('%s %s does not exist' %(key, config[key]))
+        elif len(get_event_files(config[key])) < config[n_key]:
+            errors.append('%s has less than %s=%d events' %(key, n_key, config[n_key]))
+
+    if config['network'] == 'QGNN':
+        for name in ['EN_qc', 'NN_qc']:
+            if name not in config.keys():
+                errors.append('missing key %s' %name)
+            else:
+                errors += validate_circuit(config[name], name)
+    return errors
+
+def get_n_params(config):
+    '''number of trainable parameters of the network in the config'''
+    hid_dim = config['hid_dim']
+    # InputNet
+    n_params = 3*hid_dim + hid_dim
+    if config['network'] == 'CGNN':
+        # EdgeNet and NodeNet
+        n_params += 2*(hid_dim+3)*hid_dim + hid_dim + hid_dim + 1
+        n_params += 3*(hid_dim+3)*hid_dim + hid_dim + hid_dim*hid_dim + hid_dim
+    else:
+        for name, n_in, n_out in [('EN_qc', 2, 1), ('NN_qc', 3, hid_dim)]:
+            qc = get_circuit(config[name])
+            n_qubits = config[name]['n_qubits']
+            # input layer, circuit parameters and readout layer
+            n_params += n_in*(hid_dim+3)*n_qubits + n_qubits
+            n_params += int(qc.n_params)
+            n_params += qc.n_measurements*n_out + n_out
+    return n_params
+
+def estimate_cost(config):
+    '''
+    Estimates the cost of a training run from the event sizes
+
+    Returns:
+        cost (dict): parameter count, event sizes, memory and circuit
+            executions per epoch
+    '''
+    filenames = get_event_files(config['train_dir'])[:config['n_train']]
+    sizes = np.array([get_graph_size(f) for f in filenames])
+    n_nodes, n_edges = sizes[:,0], sizes[:,1]
+
+    # graphs that are on the gradient tape at the same time
+    n_graphs = config['batch_size']
+    if get_micro_batch(config) > 0:
+        n_graphs = min(n_graphs, get_micro_batch(config))
+
+    cost = {
+        'n_params'    : get_n_params(config),
+        'n_steps'     : config['n_epoch']*(config['n_train']//config['batch_size']),
+        'mean_nodes'  : n_nodes.mean(),
+        'max_nodes'   : n_nodes.max(),
+        'mean_edges'  : n_edges.mean(),
+        'max_edges'   : n_edges.max(),
+        # dense float32 Ri and Ro matrices of the largest event
+        'max_graph_MB': (2*4*n_nodes*n_edges).max()/1e6,
+        # memory model of a training step on the largest events, without
+        # the memory used by the libraries
+        'max_step_MB' : n_graphs*max(
+            estimate_memory(n, e, config) for n, e in zip(n_nodes, n_edges)),
+    }
+    if config['network'] == 'QGNN':
+        # EdgeNet runs n_iters+1 times per edge, NodeNet n_iters times per node
+        # sampled expectations execute every circuit repetitions times
+        n_circuits = 0
+        for name, n_calls in [
+                ('EN_qc', (config['n_iters']+1)*n_edges.sum()),
+                ('NN_qc', config['n_iters']*n_nodes.sum())]:
+            n_circuits += n_calls*max(1, config[name]['repetitions'])
+        cost['circuits_per_epoch'] = int(n_circuits)
+    return cost
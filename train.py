@@ -1,56 +1,58 @@
 import sys
 import os
+import time
+# start timer before any import to measure the start-up time
+T_START = time.time()
 # Turn off warnings and errors due to TF libraries
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'  
-import time
 import datetime
 import csv
-from random import shuffle
-import tensorflow as tf
 # import internal scripts
+# TensorFlow and the quantum stack are imported after the config is validated
 from tools.tools import *
-from test import test
+from tools.validate import validate_config, estimate_cost
+from tools.dataset_specs import get_dataset_specs
+from tools.sampler import get_sampler
+from tools.subgraph import get_subgraph_sampler
+from tools.memory import get_admission_control, get_block_widths, estimate_batch_memory
+from tools.telemetry import get_telemetry
 ###############################################################################
-def batch_train_step(n_step):
-    '''combines multiple  graph inputs and executes a step on their mean'''
-    with tf.GradientTape() as tape:
-        for batch in range(config['batch_size']):
-            X, Ri, Ro, y = train_data[
-                train_list[n_step*config['batch_size']+batch]
-                ]
-
-            label = tf.reshape(tf.convert_to_tensor(y),shape=(y.shape[0],1))
-            
-            if batch==0:
-                # calculate weight for each edge to avoid class imbalance
-                weights = tf.convert_to_tensor(true_fake_weights(y))
-                # reshape weights
-                weights = tf.reshape(tf.convert_to_tensor(weights),
-                                     shape=(weights.shape[0],1))
-                preds = model([map2angle(X),Ri,Ro])
-                labels = label
-            else:
-                weight = tf.convert_to_tensor(true_fake_weights(y))
-                # reshape weights
-                weight = tf.reshape(tf.convert_to_tensor(weight),
-                                    shape=(weight.shape[0],1))
-
-                weights = tf.concat([weights, weight],axis=0)
-                preds = tf.concat([preds, model([map2angle(X),Ri,Ro])],axis=0)
-                labels = tf.concat([labels, label],axis=0)
-
-        loss_eval = loss_fn(labels, preds, sample_weight=weights)
-
-    grads = tape.gradient(loss_eval, model.trainable_variables)
-    opt.apply_gradients(zip(grads, model.trainable_variables))
-
-    return loss_eval, grads
-
 if __name__ == '__main__':
+    # Validate config file before importing the heavy libraries
+    args = parse_args()
+    errors = validate_config(read_config(args.config))
+    if errors:
+        for error in errors:
+            print('Config error: ' + error)
+        sys.exit(1)
+    print('Config validated in %.2fs' %(time.time() - T_START))
+
+    # Print the cost estimate and exit without training
+    if args.dry_run:
+        cost = estimate_cost(read_config(args.config))
+        for key in cost:
+            print(key + ': ' + str(cost[key]))
+        sys.exit(0)
+
     # Read config file
-    config = load_config(parse_args())
+    config = load_config(args)
     tools.config = config
 
+    # Derive the class weights from the statistics of the n_train training events
+    if ('class_weights' in config.keys()) and (config['class_weights'] == 'auto'):
+        specs = get_dataset_specs(
+            config['train_dir'], config['n_thread'], config['n_train']
+        )
+        config['class_weights'] = specs['class_weights']
+        print('Class weights [fake, true]: ' + str(config['class_weights']))
+
+    # Import TensorFlow and the networks
+    t_import = time.time()
+    import tensorflow as tf
+    from test import test, AsyncTester, TestPool
+    from tools.training import load_batch, batch_train_step
+    print('TensorFlow imported in %.2fs' %(time.time() - t_import))
+
     # Set GPU variables
     os.environ["CUDA_VISIBLE_DEVICES"] = config['gpu']
     USE_GPU = (config['gpu']  != '-1')
@@ -60,23 +62,15 @@ if __name__ == '__main__':
     tf.config.threading.set_intra_op_parallelism_threads(config['n_thread'])
     tf.config.threading.set_inter_op_parallelism_threads(config['n_thread'])
 
-    # Load the network
-    if config['network'] == 'QGNN':
-        from qnetworks.QGNN import GNN
-        GNN.config = config
-    elif config['network'] == 'CGNN':
-        from qnetworks.CGNN import GNN
-        GNN.config = config
-    else: 
-        print('Wrong network specification!')
-        sys.exit()
-	
-    # setup model
-    model = GNN()
+    # Load the network and setup model
+    model = build_model(config)
 
     # load data
     train_data = get_dataset(config['train_dir'], config['n_train'])
-    train_list = [i for i in range(config['n_train'])]
+    # the sampler forms the batches of every epoch
+    sampler = get_sampler(config, train_data.filenames)
+    # events are trained on as subgraphs if requested, tests use full events
+    subgraph_sampler = get_subgraph_sampler(config)
 
     # execute the model on an example data to test things
     X, Ri, Ro, y = train_data[0]
@@ -85,6 +79,39 @@ if __name__ == '__main__':
     # print model summary
     print(model.summary())
 
+    # memory in use after the setup is the baseline of the memory model
+    baseline_memory = get_peak_memory()
+    memory_widths = get_block_widths(config)
+    # split, route or skip events exceeding memory_budget if requested
+    admission = get_admission_control(config)
+    # the evaluation holds one event at a time
+    test_admission = get_admission_control(config, n_graphs=1)
+    # graphs per gradient tape, gradients of micro batches are accumulated
+    micro_batch = get_micro_batch(config)
+
+    # Evaluate weight snapshots in a background process if requested
+    if ('async_test' in config.keys()) and config['async_test']:
+        tester = AsyncTester(config)
+    else:
+        tester = None
+
+    # Evaluate the events in parallel worker processes if requested,
+    # validate_config rejects this together with async_test
+    if ('n_test_workers' in config.keys()) and (config['n_test_workers'] > 1) \
+            and (tester is None):
+        pool = TestPool(config, config['n_test_workers'])
+    else:
+        pool = None
+
+    # Evaluate a fixed random subsample at intermediate checks if requested
+    if 'test_subsample' in config.keys():
+        subsample = config['test_subsample']
+    else:
+        subsample = None
+
+    # Serve the state of the run to Prometheus if requested
+    telemetry = get_telemetry(config)
+
     # Log initial parameters if new run
     if config['run_type'] == 'new_run':    
         if config['log_verbosity']>=2:
@@ -92,8 +119,13 @@ if __name__ == '__main__':
         epoch_start = 0
 
         # Test the validation and training set
-        if config['n_valid']: test(config, model, 'valid')
-        if config['n_train']: test(config, model, 'train')
+        if tester is not None:
+            tester.submit(model, 0, 0)
+        else:
+            if config['n_valid']:
+                test(config, model, 'valid', 0, 0, pool=pool, admission=test_admission)
+            if config['n_train']:
+                test(config, model, 'train', 0, 0, pool=pool, admission=test_admission)
     # Load old parameters if continuing run
     elif config['run_type'] == 'continue':
         # load params 
@@ -119,24 +151,49 @@ if __name__ == '__main__':
 
     # Start training
     for epoch in range(epoch_start, config['n_epoch']):
-        shuffle(train_list) # shuffle the order every epoch
+        batches = sampler.get_batches() # shuffle the order every epoch
 
-        for n_step in range(config['n_train']//config['batch_size']):
+        for n_step, batch_list in enumerate(batches):
             # start timer
             t0 = datetime.datetime.now()  
 
+            # measure the peak memory of every step separately
+            reset_peak_memory()
+
             # iterate a step
-            loss_eval, grads = batch_train_step(n_step)
+            graphs, scales, low_memory = load_batch(
+                train_data, batch_list, subgraph_sampler, admission
+            )
+            if len(graphs) == 0:
+                # every event of the batch is skipped
+                continue
+            loss_eval, grads = batch_train_step(
+                model, opt, loss_fn, graphs, scales, low_memory, micro_batch
+            )
                         
             # end timer
             dt = datetime.datetime.now() - t0  
             t = dt.seconds + dt.microseconds * 1e-6 # time spent in seconds
 
+            # measured and estimated peak memory of the step in MB
+            peak_memory = get_peak_memory()
+            estimated_memory = baseline_memory + estimate_batch_memory(
+                graphs, low_memory, config, memory_widths
+            )
+
             # Print summary
             print(
                 str(datetime.datetime.now())
-                + ": Epoch: %d, Batch: %d, Loss: %.4f, Elapsed: %dm%ds" \
-                %(epoch+1, n_step+1, loss_eval.numpy() ,t / 60, t % 60)
+                + ": Epoch: %d, Batch: %d, Loss: %.4f, Elapsed: %dm%ds, Peak Memory: %dMB" \
+                %(epoch+1, n_step+1, loss_eval.numpy() ,t / 60, t % 60, peak_memory)
+                )
+
+            # Update the telemetry, the server thread formats the metrics
+            if telemetry is not None:
+                telemetry.update_step(
+                    epoch+1, n_step+1, t, graphs, float(loss_eval.numpy()), peak_memory,
+                    batches_pending=len(batches) - (n_step+1),
+                    tests_pending=tester.pending() if tester is not None else 0
                 )
             
             # Start logging 
@@ -144,8 +201,8 @@ if __name__ == '__main__':
             # Log summary 
             with open(config['log_dir']+'summary.csv', 'a') as f:
                 f.write(
-                    '%d, %d, %f, %f\n' \
-                    %(epoch+1, n_step+1, loss_eval.numpy(), t)
+                    '%d, %d, %f, %f, %f, %f\n' \
+                    %(epoch+1, n_step+1, loss_eval.numpy(), t, peak_memory, estimated_memory)
                     )
 
 	       # Log parameters
@@ -158,8 +215,24 @@ if __name__ == '__main__':
             
             # Test every TEST_every
             if (n_step+1)%config['TEST_every']==0:
-                test(config, model, 'valid')
-                test(config, model, 'train')
+                # Log the costs of the circuit simulations
+                if config['network'] == 'QGNN':
+                    model.log_backends(config['log_dir'], epoch+1, n_step+1)
+                if tester is not None:
+                    tester.submit(model, epoch+1, n_step+1, subsample)
+                else:
+                    test(config, model, 'valid', epoch+1, n_step+1, subsample, pool,
+                         test_admission)
+                    test(config, model, 'train', epoch+1, n_step+1, subsample, pool,
+                         test_admission)
+
+    # wait for the pending evaluations to finish
+    if tester is not None:
+        tester.close()
+    if pool is not None:
+        pool.close()
+    if telemetry is not None:
+        telemetry.close()
 
     print(str(datetime.datetime.now()) + ': Training completed!')
 
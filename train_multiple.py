@@ -0,0 +1,251 @@
+import sys
+import os
+import time
+# start timer before any import to measure the start-up time
+T_START = time.time()
+# Turn off warnings and errors due to TF libraries
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+import copy
+import datetime
+# import internal scripts
+# TensorFlow and the quantum stack are imported after the config is validated
+from tools.tools import *
+from tools.validate import validate_config, estimate_cost
+from tools.dataset_specs import get_dataset_specs
+from tools.sampler import get_sampler
+from tools.subgraph import get_subgraph_sampler
+from tools.memory import get_admission_control, get_block_widths, estimate_batch_memory
+###############################################################################
+# Keys that define the input pipeline, these have to be shared by all models
+SHARED_KEYS = [
+    'train_dir', 'valid_dir', 'dataset', 'n_train', 'n_valid', 'batch_size',
+    'batch_sampler', 'edge_budget', 'n_buckets', 'n_epoch', 'TEST_every',
+    'class_weights', 'test_subsample', 'gpu', 'n_thread', 'run_type',
+    'subgraph_sampling', 'subgraph_edges', 'memory_budget', 'memory_policy',
+    'micro_batch',
+]
+
+def merge_config(config, overrides):
+    '''returns a copy of config updated with overrides, dicts are merged'''
+    config = copy.deepcopy(config)
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(config.get(key), dict):
+            config[key] = merge_config(config[key], value)
+        else:
+            config[key] = value
+    return config
+
+def get_model_configs(study_config):
+    '''
+    Returns the config of every model of a study config
+
+    The study config is a regular config with an additional models
+    dictionary, which maps model names to their config overrides.
+    Every model is logged to log_dir/<name>/runN/.
+    '''
+    base_config = {k: v for k, v in study_config.items() if k != 'models'}
+    configs = {}
+    for name, overrides in study_config['models'].items():
+        for key in overrides.keys():
+            if key in SHARED_KEYS:
+                raise ValueError('%s can not be changed per model!' %key)
+        config = merge_config(base_config, overrides)
+        config['log_dir'] = base_config['log_dir'] + name + '/'
+        configs[name] = config
+    return configs
+
+if __name__ == '__main__':
+    # Validate config files before importing the heavy libraries
+    args = parse_args()
+    configs = get_model_configs(read_config(args.config))
+    errors = []
+    for name, config in configs.items():
+        errors += [name + ': ' + error for error in validate_config(config)]
+    if errors:
+        for error in errors:
+            print('Config error: ' + error)
+        sys.exit(1)
+    print('Configs validated in %.2fs' %(time.time() - T_START))
+
+    # Print the cost estimates and exit without training
+    if args.dry_run:
+        for name, config in configs.items():
+            cost = estimate_cost(config)
+            for key in cost:
+                print(name + ': ' + key + ': ' + str(cost[key]))
+        sys.exit(0)
+
+    # Read config files
+    study_dir = read_config(args.config)['log_dir']
+    if len(glob.glob(study_dir))==0:
+        os.mkdir(study_dir)
+    for name in configs:
+        configs[name] = setup_log_dir(configs[name], args.RID)
+    names = list(configs.keys())
+    # data related settings are shared, the first config is used for them
+    config = configs[names[0]]
+    tools.config = config
+
+    # Derive the class weights once from the statistics of the n_train training events
+    if ('class_weights' in config.keys()) and (config['class_weights'] == 'auto'):
+        specs = get_dataset_specs(
+            config['train_dir'], config['n_thread'], config['n_train']
+        )
+        for name in names:
+            configs[name]['class_weights'] = specs['class_weights']
+        print('Class weights [fake, true]: ' + str(config['class_weights']))
+
+    # Import TensorFlow and the networks
+    t_import = time.time()
+    import tensorflow as tf
+    from test import test_models
+    from tools.training import load_batch, batch_train_step
+    print('TensorFlow imported in %.2fs' %(time.time() - t_import))
+
+    # Set GPU variables
+    os.environ["CUDA_VISIBLE_DEVICES"] = config['gpu']
+
+    # Set number of thread to be used
+    os.environ['OMP_NUM_THREADS'] = str(config['n_thread'])  # set num workers
+    tf.config.threading.set_intra_op_parallelism_threads(config['n_thread'])
+    tf.config.threading.set_inter_op_parallelism_threads(config['n_thread'])
+
+    # Load the networks and setup models
+    models = {name: build_model(configs[name]) for name in names}
+
+    # load data
+    train_data = get_dataset(config['train_dir'], config['n_train'])
+    # the sampler forms the batches of every epoch
+    sampler = get_sampler(config, train_data.filenames)
+    # events are trained on as subgraphs if requested, tests use full events
+    subgraph_sampler = get_subgraph_sampler(config)
+
+    # execute the models on an example data to test things
+    X, Ri, Ro, y = train_data[0]
+    X = map2angle(X)
+    for name in names:
+        models[name]([X, Ri, Ro])
+        print(name + ':')
+        print(models[name].summary())
+
+    # memory in use after the setup is the baseline of the memory model
+    baseline_memory = get_peak_memory()
+    memory_widths = {name: get_block_widths(configs[name]) for name in names}
+    # the admission uses the first model, models of a study share the batches
+    admission = get_admission_control(config)
+    # the evaluation holds one event at a time
+    test_admission = get_admission_control(config, n_graphs=1)
+    # graphs per gradient tape, gradients of micro batches are accumulated
+    micro_batch = get_micro_batch(config)
+
+    # Evaluate a fixed random subsample at intermediate checks if requested
+    if 'test_subsample' in config.keys():
+        subsample = config['test_subsample']
+    else:
+        subsample = None
+
+    model_configs = [configs[name] for name in names]
+    model_list = [models[name] for name in names]
+
+    # Log initial parameters if new run
+    if config['run_type'] == 'new_run':
+        for name in names:
+            if configs[name]['log_verbosity']>=2:
+                log_parameters(configs[name]['log_dir'], models[name].trainable_variables)
+        epoch_start = 0
+
+        # Test the validation and training set
+        if config['n_valid']: test_models(model_configs, model_list, 'valid', 0, 0,
+                                          admission=test_admission)
+        if config['n_train']: test_models(model_configs, model_list, 'train', 0, 0,
+                                          admission=test_admission)
+    # Load old parameters if continuing run
+    elif config['run_type'] == 'continue':
+        # load params, continue from the model that is furthest behind
+        epoch_start = config['n_epoch']
+        for name in names:
+            models[name], epoch = load_params(models[name], configs[name]['log_dir'])
+            epoch_start = min(epoch_start, epoch)
+    else:
+        raise ValueError('Run type not defined!')
+
+    # Get loss functions and optimizers
+    loss_fns, opts = {}, {}
+    for name in names:
+        loss_fns[name] = getattr(tf.keras.losses, configs[name]['loss_func'])()
+        opts[name] = getattr(
+            tf.keras.optimizers,
+            configs[name]['optimizer'])(learning_rate=configs[name]['lr_c']
+        )
+
+    # Print final message before training
+    print(
+        str(datetime.datetime.now())
+        + ': Training of %d models is starting from epoch %d!' %(len(names), epoch_start+1)
+        )
+
+    # Start training
+    for epoch in range(epoch_start, config['n_epoch']):
+        batches = sampler.get_batches() # shuffle the order every epoch
+
+        for n_step, batch_list in enumerate(batches):
+            # load the batch once for all models
+            t0 = time.time()
+            graphs, scales, low_memory = load_batch(
+                train_data, batch_list, subgraph_sampler, admission
+            )
+            t_load = time.time() - t0
+            if len(graphs) == 0:
+                # every event of the batch is skipped
+                continue
+
+            for name in names:
+                # start timer and measure the peak memory of every step
+                t0 = time.time()
+                reset_peak_memory()
+
+                # iterate a step
+                loss_eval, grads = batch_train_step(
+                    models[name], opts[name], loss_fns[name], graphs, scales, low_memory,
+                    micro_batch
+                )
+
+                # time spent in seconds, loading time is shared by all models
+                t = time.time() - t0 + t_load
+                peak_memory = get_peak_memory()
+                estimated_memory = baseline_memory + estimate_batch_memory(
+                    graphs, low_memory, configs[name], memory_widths[name]
+                )
+                log_dir = configs[name]['log_dir']
+
+                # Print summary
+                print(
+                    str(datetime.datetime.now())
+                    + ": Model: %s, Epoch: %d, Batch: %d, Loss: %.4f, Elapsed: %dm%ds, Peak Memory: %dMB" \
+                    %(name, epoch+1, n_step+1, loss_eval.numpy() ,t / 60, t % 60, peak_memory)
+                    )
+
+                # Log summary
+                with open(log_dir+'summary.csv', 'a') as f:
+                    f.write(
+                        '%d, %d, %f, %f, %f, %f\n' \
+                        %(epoch+1, n_step+1, loss_eval.numpy(), t, peak_memory, estimated_memory)
+                        )
+
+                # Log parameters and gradients
+                if configs[name]['log_verbosity']>=2:
+                    log_parameters(log_dir, models[name].trainable_variables)
+                    log_gradients(log_dir, grads)
+
+            # Test every TEST_every
+            if (n_step+1)%config['TEST_every']==0:
+                # Log the costs of the circuit simulations
+                for name in names:
+                    if configs[name]['network'] == 'QGNN':
+                        models[name].log_backends(configs[name]['log_dir'], epoch+1, n_step+1)
+                test_models(model_configs, model_list, 'valid', epoch+1, n_step+1,
+                            subsample, admission=test_admission)
+                test_models(model_configs, model_list, 'train', epoch+1, n_step+1,
+                            subsample, admission=test_admission)
+
+    print(str(datetime.datetime.now()) + ': Training completed!')